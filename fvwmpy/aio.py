@@ -0,0 +1,390 @@
+"""asyncio front end for fvwmpy.
+
+    from fvwmpy.aio import aiofvwmpy
+
+aiofvwmpy is used like fvwmpy.fvwmpy, but packets are read from the
+pipe by the running event loop instead of the reader thread. Methods
+that wait for FVWM are coroutines and handlers may be coroutine
+functions.
+"""
+import asyncio
+import inspect
+import time
+
+from   .constants     import *
+from   .exceptions    import *
+from   .fvwmpy        import ( fvwmpy, _fvwmvar, _infostore,
+                                _winlist, _delta_picker, _delta_until )
+from   .packet_queue  import _packet_queue
+from   .picker        import picker
+
+################################################################################
+### some helpers
+
+class _aio_waiter:
+    """A coroutine waiting in _aio_packet_queue.pick() for a packet, for
+    which picker evaluates to True.
+    """
+    __slots__ = ( "picker", "mask", "event", "found" )
+
+    def __init__(self,picker,mask):
+        self.picker = picker
+        self.mask   = mask
+        self.event  = asyncio.Event()
+        self.found  = False
+
+class _protocol(asyncio.Protocol):
+    """Passes whatever arrives in the pipe to the packet queue"""
+
+    def __init__(self,queue):
+        self._queue = queue
+
+    def data_received(self,data):
+        self._queue._received(data)
+
+    def eof_received(self):
+        self._queue._failed(EOFError("FVWM closed the pipe"))
+
+    def connection_lost(self,exc):
+        if exc is not None:
+            self._queue._failed(exc)
+
+async def _wait(event,deadline):
+    """Wait for event until deadline (in terms of loop.time()).
+    Return False on timeout.
+    """
+    if deadline is None:
+        await event.wait()
+        return True
+    timeout = deadline - asyncio.get_running_loop().time()
+    if timeout <= 0:
+        return event.is_set()
+    try:
+        await asyncio.wait_for(event.wait(),timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+def _deadline(timeout):
+    if timeout is None:
+        return None
+    return asyncio.get_running_loop().time() + timeout
+
+async def _await(r):
+    return await r
+
+async def _call(h,p):
+    """Call handler h and wait for it if it is a coroutine function"""
+    r = h(p)
+    if inspect.isawaitable(r):
+        await r
+
+################################################################################
+###
+
+class _aio_packet_queue(_packet_queue):
+    """Packet queue fed by the event loop. read() and pick() are
+    coroutines. The pipe is connected to the loop on the first call
+    of either of them.
+    """
+
+    def _start(self):
+        self._transport = None
+        self._arrived   = asyncio.Event()
+
+    async def connect(self):
+        """Start reading the pipe in the running event loop"""
+        if self._transport is not None: return
+        loop = asyncio.get_running_loop()
+        self._transport, _ = await loop.connect_read_pipe(
+            lambda: _protocol(self), self._pipe )
+        self.debug(" Connected to the event loop")
+
+    def close(self):
+        """Stop reading the pipe"""
+        if self._transport is not None:
+            self._transport.close()
+
+    def _received(self,data):
+        framer = self._framer
+        framer.feed(data)
+        while True:
+            try:
+                frames = framer.split()
+            except PipeDesync as e:
+                ### The framer will skip to the next packet
+                self.error( "reader: {}",repr(e))
+                self.error( "reader: Resync the pipe. "+
+                            "Packet(s) may be lost.")
+                continue
+            if not frames: break
+            packs = self._make(frames)
+            ### everything runs in the loop, the lock only guards the
+            ### counters against threads calling metrics.snapshot()
+            with self._lock:
+                self.metrics._arrived(packs)
+            packs, replies = self._demux(packs)
+            self._resolve(replies)
+            self.metrics._tick()
+            self._synced(packs)
+            self.debug("reader: got {} packets",len(packs))
+            for p in packs:
+                self._append(p)
+            for w in self._waiters:
+                if not w.found and self._matches(w,packs):
+                    w.found = True
+                    w.event.set()
+            if packs:
+                self._arrived.set()
+
+    def _failed(self,e):
+        self.error("reader: {}",repr(e))
+        self._thread_exception = e
+        replies = self._replies
+        self._replies = dict()
+        self._fail(replies.values(),e)
+        for w in self._waiters:
+            w.event.set()
+        self._arrived.set()
+
+    async def read(self,keep=False,timeout=None):
+        """Read the packet from the top of the queue. See
+        _packet_queue.read()
+        """
+        await self.connect()
+        if not self._count:
+            self._idle()
+        self._check_exception()
+        deadline = _deadline(timeout)
+        while not self._count:
+            self._arrived.clear()
+            if not await _wait(self._arrived,deadline):
+                self.debug("read: queue is empty, returning None after timeout")
+                return None
+            self._check_exception()
+        e = self._head()
+        p = e.packet
+        if not keep:
+            self._remove(e)
+        return p
+
+    async def pick(self,picker,until=None,timeout=0.5,keep=False):
+        """Find and return packets from the queue. See
+        _packet_queue.pick()
+        """
+        await self.connect()
+        if until is None:
+            until = picker
+        pmask = getattr(picker,"mask",None)
+        umask = getattr(until,"mask",None)
+        self._idle()
+        self._check_exception()
+        stop = self._find(until,umask)
+        if stop is None:
+            w = _aio_waiter(until,umask)
+            self._waiters.append(w)
+            try:
+                await _wait(w.event,_deadline(timeout))
+            finally:
+                self._waiters.remove(w)
+            self._check_exception()
+            stop = self._find(until,umask)
+        found = list()
+        for e in self._entries(pmask):
+            if stop is not None and e.seq > stop:
+                break
+            if picker(e.packet):
+                found.append(e)
+        if not keep:
+            for e in found:
+                self._remove(e)
+        return [ e.packet for e in found ]
+
+class _aio_fvwmvar(_fvwmvar):
+    """Like fvwmpy.var, but values have to be awaited
+
+    await m.var.w_name
+    await m.var("w.name","w.id")
+    """
+
+    async def __call__(self, *args,context_window=None):
+        reply = await self._module.getreply(self._question(args),
+                                            context_window=context_window)
+        return self._answer(reply,args)
+
+class _aio_infostore(_infostore):
+    """Like fvwmpy.infostore, but values have to be awaited
+
+    await m.infostore.name
+    await m.infostore("name1","name2")
+
+    Assignment and deletion work as usual.
+    """
+
+    async def __call__(self, *args,context_window=None):
+        reply = await self._module.getreply(self._question(args))
+        return self._answer(reply,args)
+
+class _aio_winlist(_winlist):
+    """Like fvwmpy.winlist, but filter() is an asynchronous generator
+
+    async for w in m.winlist.filter("CurrentPage"): ...
+    """
+
+    async def filter(self,conditions,local=True):
+        found = self._local(conditions) if local else None
+        if found is not None:
+            for w in found:
+                yield w
+            return
+        module = self._module
+        filteredlist = list()
+        with module.masks(M_STRING|M_ERROR,0,0):
+            self._ask(conditions)
+            p = await module.packets.read()
+            while p.ptype & M_STRING and p.string.startswith("0x"):
+                filteredlist.append( int(p.string,0) )
+                p = await module.packets.read()
+            if p.ptype & M_ERROR:
+                module.error("winlist: {}",p.string)
+                raise FvwmError(p.string)
+        for wid in filteredlist:
+            yield self[wid]
+
+class aiofvwmpy(fvwmpy):
+    """Base class for developing Fvwm modules with asyncio"""
+
+    _packet_queue_class = _aio_packet_queue
+    _winlist_class      = _aio_winlist
+    _fvwmvar_class      = _aio_fvwmvar
+    _infostore_class    = _aio_infostore
+
+    def exit(self,n=0):
+        """Exit from the module with exit status n"""
+        self.packets.close()
+        super().exit(n)
+
+    async def getreply(self,msg,context_window=None,timeout=0.5):
+        """Send a string to FVWM in context context_window
+        get the reply and return it
+        """
+        await self.packets.connect()
+        f, = self.sendreplies(msg,context_window=context_window)
+        self.flush()
+        await asyncio.wait( [ asyncio.wrap_future(f) ], timeout = timeout )
+        if f.cancel():
+            self.warn( "getreply: didn't get any reply from FVWM, return None")
+            return
+        return f.result()
+
+    async def getreplies(self,*msgs,context_window=None,timeout=0.5):
+        """Send all msgs to FVWM at once and return the list of replies.
+        See fvwmpy.getreplies()
+        """
+        await self.packets.connect()
+        futures = self.sendreplies(*msgs,context_window=context_window)
+        self.flush()
+        if futures:
+            await asyncio.wait( [ asyncio.wrap_future(f) for f in futures ],
+                                timeout = timeout )
+        return self._collect(futures)
+
+    async def getconfig(self, handler=None, match=None, timeout=0.5):
+        """Ask FVWM for module configuration information. See
+        fvwmpy.getconfig()
+        """
+        if match is None: match   = "*" + self.alias
+        reload = handler is None
+        try:
+            with self.masks(self.mask|M_FOR_CONFIG,0,0):
+                self.sendmessage("Send_ConfigInfo {}".format(match))
+                if reload:
+                    handler = self.h_saveconfig
+                    self.config.begin(match)
+                    self.rawconfig = list()
+                packs = await self.packets.pick(
+                    picker  = picker(mask=M_FOR_CONFIG),
+                    until   = picker(mask=M_END_CONFIG_INFO),
+                    timeout = timeout )
+                self.info( "getconfig: got {} config packets",len(packs))
+            for p in packs:
+                await _call(handler,p)
+        finally:
+            if reload: self.config.abort()
+        return packs[-1].ptype == M_END_CONFIG_INFO
+
+    async def getwinlist(self, handler = None, timeout=0.5):
+        """Ask FVWM for the list of all windows. See fvwmpy.getwinlist()
+        """
+        handler, mask = self._winlist_handler(handler)
+        with self.masks(self.mask|mask,0,0):
+            self.sendmessage("Send_WindowList")
+            packs = await self.packets.pick(
+                picker  = picker(mask = mask),
+                until   = picker(mask = M_END_WINDOWLIST),
+                timeout = timeout )
+            self.info( "getwinlist: got {} winlist packets",len(packs))
+        for p in packs:
+            await _call(handler,p)
+        return packs[-1].ptype == M_END_WINDOWLIST
+
+    async def loadsnapshot(self,path=None,config=True,reconcile=True,
+                           timeout=0.5):
+        """Fill m.winlist and m.config from the snapshot. See
+        fvwmpy.loadsnapshot()
+        """
+        restored = self._restore_snapshot(path,config)
+        if restored is None:
+            return False
+        colorsets, fetch = restored
+        if fetch:
+            await self.getconfig(timeout=timeout)
+        if not reconcile:
+            return True
+        flags = self._delta_flags()
+        if flags is None and colorsets is None:
+            return await self.getwinlist(timeout=timeout)
+        with self.masks(M_STRING|M_ERROR,0,0):
+            self._ask_delta(flags,colorsets)
+            packs = await self.packets.pick( picker  = _delta_picker,
+                                             until   = _delta_until,
+                                             timeout = timeout )
+        delta = self._parse_delta(packs,colorsets)
+        if not self._config_fresh(delta,colorsets):
+            await self.getconfig(timeout=timeout)
+        if not self._apply_delta(delta,flags):
+            return await self.getwinlist(timeout=timeout)
+        return True
+
+    async def call_handlers(self,p):
+        """Execute all handlers in the queue for the packet p passing p as an
+        argument in the order of their priority and registration.
+        Coroutine handlers are awaited before the next one is called.
+        """
+        start   = time.perf_counter()
+        for h in self._dispatch(p):
+            await _call(h,p)
+        self.packets.metrics._handled(p.ptype,time.perf_counter()-start)
+
+    def _submit(self,h,p):
+        ### called from call_handlers(), so the loop is running
+        self._loop = asyncio.get_running_loop()
+        super()._submit(h,p)
+
+    def _work(self,h,p):
+        """Call the worker handler h in the pool thread. Coroutine
+        handlers are run by the loop, while the pool thread waits for
+        them, so that the order of packets of a window is kept.
+        """
+        r = h(p)
+        if inspect.isawaitable(r):
+            asyncio.run_coroutine_threadsafe(_await(r),self._loop).result()
+
+    async def run(self):
+        """Mainloop.
+        Read packets and execute corresponding handlers.
+        """
+        self.debug(" Start main loop")
+        while True:
+            p = await self.packets.read()
+            await self.call_handlers(p)
@@ -0,0 +1,52 @@
+class colorset(tuple):
+    """Colorset as sent by FVWM to modules in 'Colorset' config lines
+    decoded into a tuple of integers.
+
+    cs = colorset(["1", "ffffff", "000000", ...])
+
+    The first element of the line is the number of the colorset (it is
+    cs.number), the rest are hexadecimal numbers making up the tuple.
+    Fields listed in colorset.fields are accessible by name, e.g.
+    cs.fg is the pixel value of the foreground color. colorset.fields
+    maps names to indices in the tuple.
+
+    The layout of the line is the one of DumpColorset() in the FVWM
+    source tree (libs/Colorset.c), only the colors, that come first in
+    all FVWM 2.6 versions, are listed by default. Add others for your
+    FVWM:
+
+    colorset.fields["tint"] = 5
+    """
+
+    fields = { "fg"     : 0,
+               "bg"     : 1,
+               "hilite" : 2,
+               "shadow" : 3,
+               "fgsh"   : 4 }
+
+    def __new__(cls,tokens):
+        self = super().__new__(cls,( int(t,16) for t in tokens[1:] ))
+        self.number = int(tokens[0],16)
+        return self
+
+    def __getattr__(self,name):
+        try:
+            return self[self.fields[name]]
+        except (KeyError, IndexError):
+            raise AttributeError(name)
+
+    def rgb(self,name):
+        """Return (red, green, blue) of the named color assuming a
+        24 bit TrueColor visual.
+        """
+        pixel = getattr(self,name)
+        return ( (pixel >> 16) & 0xff, (pixel >> 8) & 0xff, pixel & 0xff )
+
+    def __repr__(self):
+        return "colorset({:x}: {})".format(
+            self.number,
+            ",".join( "{}={:06x}".format(name,getattr(self,name))
+                      for name in self.fields
+                      if self.fields[name] < len(self) ))
+
+    __str__ = __repr__
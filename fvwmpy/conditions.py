@@ -0,0 +1,207 @@
+"""Local evaluation of FVWM conditions (as in FVWM's All, Next, ...
+commands) against the winlist database.
+
+match = compile_conditions("!Iconic, CurrentPage, *term")
+
+returns a callable match(winlist,w), which tells if window w from
+winlist satisfies the conditions, or None if some of the conditions
+can only be decided by FVWM. match raises Undecidable, if winlist
+does not know enough (e.g. the current desk) to decide.
+
+FVWM skips windows with CirculateSkip, CirculateSkipIcon and
+CirculateSkipShaded styles unless the conditions contain CirculateHit,
+CirculateHitIcon and CirculateHitShaded. The styles are not sent to
+modules, so conditions without CirculateHit are decided locally only if
+"circulate_skip" is in fvwmpy.windowflags.bits, and iconic (shaded)
+windows only with CirculateHitIcon (CirculateHitShaded) or the
+"circulate_skip_icon" ("circulate_skip_shaded") flag.
+
+Compiled conditions are cached. Call compile_conditions.cache_clear()
+after changing fvwmpy.windowflags.bits.
+"""
+import functools
+
+from .picker import Glob
+from .flags  import windowflags
+
+class Undecidable(Exception):
+    """The winlist database does not have information to decide"""
+    pass
+
+### All conditions known to FVWM (lower case). Those, that are not in
+### _local, can only be decided by FVWM.
+_keywords = {
+    "acceptsfocus", "anyscreen", "circulatehit", "circulatehiticon",
+    "circulatehitshaded", "closable", "currentdesk", "currentglobalpage",
+    "currentglobalpageanydesk", "currentpage", "currentpageanydesk",
+    "currentscreen", "desk", "fixedposition", "fixedsize", "focused",
+    "hashandles", "haspointer", "hastitle", "iconic", "iconifiable",
+    "layer", "maximizable", "maximized", "overlapped", "placedbybutton",
+    "placedbybutton3", "placedbyfvwm", "raised", "screen", "shaded",
+    "state", "sticky", "stickyacrossdesks", "stickyacrosspages",
+    "stickyicon", "stickyacrossdesksicon", "stickyacrosspagesicon",
+    "transient", "visible" }
+
+### window attributes matched against name patterns
+_names = ( "win_name", "ico_name", "res_class", "res_name" )
+
+def _desk(wl):
+    if wl.desk is None:
+        raise Undecidable("current desk is not known")
+    return wl.desk
+
+def _on_screen(wl,w):
+    """Does window w intersect the visible part of the desk?"""
+    width, height = wl.screen
+    if not width or not height:
+        raise Undecidable("size of the screen is not known")
+    try:
+        x, y, dx, dy = w["wx"], w["wy"], w["wdx"], w["wdy"]
+    except KeyError:
+        raise Undecidable("geometry of the window is not known")
+    return x < width and y < height and x + dx > 0 and y + dy > 0
+
+def _iconic(arg):
+    return lambda wl, w: w.get("iconified",False)
+
+def _shaded(arg):
+    return lambda wl, w: w.get("shaded",False)
+
+def _currentdesk(arg):
+    return lambda wl, w: w.get("desk") == _desk(wl)
+
+def _currentpage(arg):
+    return lambda wl, w: w.get("desk") == _desk(wl) and _on_screen(wl,w)
+
+def _currentpageanydesk(arg):
+    return lambda wl, w: _on_screen(wl,w)
+
+def _layer(arg):
+    ### Layer without argument refers to the layer of the current window
+    if arg is None:
+        return None
+    return lambda wl, w: w.get("layer") == arg
+
+def _flag(name):
+    """Condition decided by the flag name of fvwmpy.windowflags"""
+    def factory(arg):
+        if name not in windowflags.bits:
+            return None
+        def match(wl,w):
+            try:
+                return getattr(w["winflags"],name)
+            except KeyError:
+                raise Undecidable("flags of the window are not known")
+        return match
+    return factory
+
+def _pattern(token):
+    """Name pattern. Alternatives may be separated with '|'."""
+    globs = tuple( Glob(t) for t in token.split("|") )
+    def match(wl,w):
+        for key in _names:
+            val = w.get(key)
+            if val is None: continue
+            for g in globs:
+                if g == val: return True
+        return False
+    return match
+
+### condition -> factory taking the argument (or None) and returning
+### the predicate, or None if it can not be decided locally
+_local = {
+    "iconic"             : _iconic,
+    "shaded"             : _shaded,
+    "currentdesk"        : _currentdesk,
+    "currentpage"        : _currentpage,
+    "currentpageanydesk" : _currentpageanydesk,
+    "layer"              : _layer,
+    "stickyacrosspages"  : _flag("sticky_across_pages"),
+    "stickyacrossdesks"  : _flag("sticky_across_desks"),
+    }
+
+### conditions overriding CirculateSkip* styles -> (flag of the style,
+### window attribute the style applies to or None)
+_circulate = {
+    "circulatehit"       : ("circulate_skip",        None),
+    "circulatehiticon"   : ("circulate_skip_icon",   "iconified"),
+    "circulatehitshaded" : ("circulate_skip_shaded", "shaded") }
+
+def _skip(flag,attr):
+    """Predicate telling that FVWM does not skip window w for the style
+    flag or None if it can not be decided
+    """
+    if flag in windowflags.bits:
+        def match(wl,w):
+            if attr is not None and not w.get(attr,False):
+                return True
+            try:
+                return not getattr(w["winflags"],flag)
+            except KeyError:
+                raise Undecidable("flags of the window are not known")
+        return match
+    if attr is None:
+        return None
+    def match(wl,w):
+        if w.get(attr,False):
+            raise Undecidable("{} is not known".format(flag))
+        return True
+    return match
+
+### conditions, that may be followed by a numeric argument
+_witharg = { "layer", "desk", "screen", "state", "placedbybutton" }
+
+def _tokens(conditions):
+    """Split the conditions into (negated, keyword, argument) triples"""
+    for cond in conditions.split(","):
+        words = cond.split()
+        i = 0
+        while i < len(words):
+            word = words[i]
+            i += 1
+            negated = word.startswith("!")
+            if negated: word = word[1:]
+            arg = None
+            if ( word.lower() in _witharg and i < len(words) and
+                 words[i].lstrip("-").isdigit() ):
+                arg = int(words[i])
+                i += 1
+            yield negated, word, arg
+
+def _negate(f):
+    return lambda wl, w: not f(wl,w)
+
+@functools.lru_cache(maxsize=256)
+def compile_conditions(conditions):
+    predicates = list()
+    hit = set()
+    for negated, word, arg in _tokens(conditions):
+        if not word or word[0] in "\"'`":
+            ### quoted names are left to FVWM
+            return None
+        key = word.lower()
+        if key in _circulate:
+            if negated:
+                return None
+            hit.add(key)
+            continue
+        if key in _keywords:
+            factory = _local.get(key)
+            f = factory(arg) if factory else None
+        else:
+            f = _pattern(word)
+        if f is None:
+            return None
+        predicates.append( _negate(f) if negated else f )
+    for key, (flag, attr) in _circulate.items():
+        if key in hit: continue
+        f = _skip(flag,attr)
+        if f is None:
+            return None
+        predicates.append(f)
+    predicates = tuple(predicates)
+    def match(wl,w):
+        for f in predicates:
+            if not f(wl,w): return False
+        return True
+    return match
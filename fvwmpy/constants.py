@@ -101,6 +101,11 @@ M_FOR_WINLIST  = ( M_CONFIGURE_WINDOW | M_ADD_WINDOW | M_WINDOW_NAME |
 ### This are packets that are sent when configuration is requested
 M_FOR_CONFIG   = ( M_CONFIG_INFO | M_END_CONFIG_INFO | M_SENDCONFIG )
 
+### These are packets that keep the winlist database up to date
+M_FOR_WINDB    = ( M_FOR_WINLIST | M_NEW_PAGE | M_NEW_DESK |
+                   M_ICONIFY | M_DEICONIFY |
+                   M_WINDOWSHADE | M_DEWINDOWSHADE )
+
 packets = { "M_NEW_PAGE", "M_NEW_DESK", "M_OLD_ADD_WINDOW", "M_RAISE_WINDOW",
             "M_LOWER_WINDOW", "M_OLD_CONFIGURE_WINDOW", "M_FOCUS_CHANGE",
             "M_DESTROY_WINDOW", "M_ICONIFY", "M_DEICONIFY", "M_WINDOW_NAME",
@@ -0,0 +1,53 @@
+class windowflags(int):
+    """Window flags from M_CONFIGURE_WINDOW (or M_ADD_WINDOW) packet
+    decoded into an integer. Bit i of the integer is bit i % 8 of byte
+    i // 8 of the raw flags.
+
+    f = windowflags(p.flags)
+
+    Flags listed in windowflags.bits are accessible by name, e.g.
+    f.sticky_across_pages is True or False. windowflags.bits maps
+    names to bit numbers (or tuples of them, then the flag is set if
+    any of the bits is).
+
+    The layout of the flags is the layout of the window_flags
+    structure of the FVWM binary (see window_flags.h and vpacket.h in
+    the FVWM source tree), which depends on the version of FVWM and on
+    the compiler. Only the bits, that are at the beginning of the
+    structure in all FVWM 2.6 versions, are listed by default. Add
+    others (e.g. iconified, maximized, focus policy) to
+    windowflags.bits for your FVWM:
+
+    windowflags.bits["maximized"] = 123
+    """
+
+    bits = { "sticky_across_pages" : 0,
+             "sticky_across_desks" : 1,
+             "sticky"              : (0, 1) }
+
+    def __new__(cls,flags=0):
+        if not isinstance(flags,int):
+            flags = int.from_bytes(flags,"little")
+        return super().__new__(cls,flags)
+
+    def __getattr__(self,name):
+        try:
+            return bool( self & self.mask(name) )
+        except KeyError:
+            raise AttributeError(name)
+
+    def __repr__(self):
+        names = [ name for name in self.bits if getattr(self,name) ]
+        return "windowflags(0x{:x}: {})".format(int(self),",".join(names))
+
+    __str__ = __repr__
+
+    @classmethod
+    def mask(cls,*names):
+        """Integer with bits of all named flags set"""
+        m = 0
+        for name in names:
+            bit = cls.bits[name]
+            for b in ( bit if isinstance(bit,tuple) else (bit,) ):
+                m |= 1 << b
+        return m
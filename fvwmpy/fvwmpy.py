@@ -1,15 +1,26 @@
+import concurrent.futures as _futures
+import collections as _collections
+import contextlib as _contextlib
+import itertools as _itertools
 import os as _os
 import sys as _sys
 import struct as _struct
+import threading as _threading
 import time as _time
 
 from   .constants     import *
 from   .packet_queue  import _packet_queue
 ### this is needed to set logging level
-from   .packet        import packet
+from   .packet        import packet, compactpacket, lazypacket
 from   .exceptions    import *
 from   .log           import _getloggers
 from   .picker        import picker, glob, Glob
+from   .conditions    import compile_conditions, Undecidable
+from   .flags         import windowflags
+from   .geometry      import geometry, xinerama_screens
+from   .sync          import syncstats
+from   .colorset      import colorset
+from   .              import snapshot as _snapshot
 
 ################################################################################
 ### Some helpers
@@ -30,10 +41,11 @@ class _unique_id:
     string with every invocation
     """
     
-    uid = int(_time.perf_counter()*1000000000)
+    ### next() on itertools.count is atomic, so it is safe to call from
+    ### several threads
+    _uids = _itertools.count(int(_time.perf_counter()*1000000000) + 1)
     def __call__(self,fmt="unique_id_0x{:x}"):
-        self.uid += 1
-        return fmt.format(self.uid)
+        return fmt.format(next(self._uids))
 
 unique_id =  _unique_id()
 
@@ -93,9 +105,15 @@ class _fvwmvar:
         raise IllegalOperation("It is not possible to delete Fvwm variables")
 
     def __call__(self, *args,context_window=None):
+        reply = self._module.getreply(self._question(args),
+                                      context_window=context_window)
+        return self._answer(reply,args)
+
+    def _question(self,args):
         vardots = ["$[{}]".format(x.replace("_",".")) for x in args]
-        varline = self._sep.join(vardots)
-        reply = self._module.getreply(varline, context_window=context_window)
+        return self._sep.join(vardots)
+
+    def _answer(self,reply,args):
         values= reply.split(self._sep)
         if len(values) != len(args):
             raise FvwmError("fvwmvar: Something is wrong, "+
@@ -149,10 +167,15 @@ class _infostore:
         self._module.sendmessage("InfoStoreRemove {}".format(vardots))
 
     def __call__(self, *args,context_window=None):
+        return self._answer(self._module.getreply(self._question(args)),args)
+
+    def _question(self,args):
         vardots = [ "$[infostore.{}]".format(x.replace("_","."))
                     for x in args ]
-        varline = self._sep.join(vardots)
-        reply = self._module.getreply(varline).split(self._sep)
+        return self._sep.join(vardots)
+
+    def _answer(self,reply,args):
+        reply = reply.split(self._sep)
         if len(reply) != len(args):
             raise FvwmError("infostore: Something is wrong, "+
                             "more answers then questions or vice versa.",
@@ -168,10 +191,10 @@ class _window(dict):
     reply to Send_WindowList message. It has an additional method
     w.flag(int: i), that gives the value of i^th flag, see 
     file vpacket.h in fvwm source tree for the meaning of the flags.
+    w.winflags holds the flags decoded into fvwmpy.windowflags, which
+    gives access to flags by names.
     The __str__ method gives some human readable representation of the 
     instance of the _window class.
-
-    ToDo: Access flags by meaningfull names.
     """
 
     def __getattr__(self,attr):
@@ -183,8 +206,7 @@ class _window(dict):
     def flag(self,i):
         """Get the i^th flag of the window as a 0/1 integer
         """
-        b,s = divmod(i,8)
-        return self.flags[b] & ( 1 << s )
+        return ( self.winflags >> i ) & 1
 
     def __str__(self):
         res = list()
@@ -200,36 +222,271 @@ class _window(dict):
 class _winlist(dict):
     """Dictionary of all windows indexed by window id's.  
 
+    It is kept up to date by w.apply(p) (see fvwmpy.h_updatewl) and
+    has indices for attributes in _winlist._indexed, so that
+    w.select(**kwargs) does not have to look at every window.
+
     Additional method .filter(conditions) gives an
     iterator over windows satisfying conditions, where conditions is a 
     string of conditions acceptable to FVWM's conditional commands and 
     have the same meaning.
     """
+
+    ### window attributes, that have indices
+    _indexed = ( "desk", "page", "res_class", "res_name", "layer",
+                 "iconified", "shaded" )
+    ### packet keys, that do not go into windows
+    _skipkeys = { "body", "ptype", "time" }
+
     def __init__(self,module):
         super().__init__()
         super().__setattr__("_module",module)
-                
-    def filter(self,conditions):
+        ### attribute -> value -> set of window ids
+        self._index   = { key : dict() for key in self._indexed }
+        ### from M_NEW_DESK and M_NEW_PAGE packets
+        self.desk     = None
+        self.viewport = (0, 0)
+        self.screen   = (None, None)
+        self.pages    = (None, None)
+        ### Got the whole window list from FVWM
+        self.complete = False
+        ### columnar copy of window geometry, see fvwmpy.geometry
+        self.geometry = geometry() if module.columnar else None
+        ### Every window has a slot in _flagwords holding its
+        ### windowflags, see withflags()
+        self._slots     = dict()
+        self._wids      = list()
+        self._flagwords = list()
+        self._free      = list()
+
+    def __setitem__(self,wid,w):
+        if wid in self:
+            self._unindex(wid,self[wid])
+        super().__setitem__(wid,w)
+        self._reindex(wid,w,dict())
+        self._setflags(wid,w.get("winflags",0))
+
+    def __delitem__(self,wid):
+        self._unindex(wid,self[wid])
+        self._ungeometry(wid)
+        super().__delitem__(wid)
+
+    def pop(self,wid,*default):
+        if wid in self:
+            self._unindex(wid,self[wid])
+            self._ungeometry(wid)
+        return super().pop(wid,*default)
+
+    def clear(self):
+        super().clear()
+        self.complete = False
+        self._slots.clear()
+        self._wids.clear()
+        self._flagwords.clear()
+        self._free.clear()
+        if self.geometry is not None:
+            self.geometry.clear()
+        for index in self._index.values():
+            index.clear()
+
+    def apply(self,p):
+        """Update the database with the information in packet p.
+        Packets of types not matching M_FOR_WINDB are ignored.
+        """
+        try:
+            apply = self._appliers[p.ptype]
+        except KeyError:
+            return
+        apply(self,p)
+
+    def select(self,**kwargs):
+        """Return the list of windows (in no particular order) with the
+        given values of attributes, e.g. 
+
+        w.select(desk=0, iconified=False, res_class=glob("*term"))
+
+        Values may be glob or Glob objects. Indexed attributes are
+        looked up in the indices, others are compared window by window.
+        """
+        wids = None
+        rest = list()
+        for key, val in kwargs.items():
+            index = self._index.get(key)
+            if index is None:
+                rest.append( (key, val) )
+                continue
+            if isinstance(val,(glob,Glob)):
+                found = set()
+                for v, ws in index.items():
+                    if isinstance(v,str) and val == v:
+                        found |= ws
+            else:
+                found = index.get(val,())
+            wids = set(found) if wids is None else wids & found
+            if not wids:
+                return list()
+        windows = self.values() if wids is None else map(self.get,wids)
+        return [ w for w in windows
+                 if all( k in w and w[k] == v for k, v in rest ) ]
+
+    def withflags(self,**kwargs):
+        """Return the list of windows, whose flags named in kwargs (see
+        fvwmpy.windowflags) have the given values, e.g.
+
+        w.withflags(sticky_across_pages=True, sticky_across_desks=False)
+
+        It scans the list of flags of all windows in python. The raw
+        flags are usually wider than 64 bits, so they are not kept in
+        an array.
+        """
+        tests = [ ( windowflags.mask(name), bool(val) )
+                  for name, val in kwargs.items() ]
+        wids  = self._wids
+        if len(tests) == 1:
+            m, want = tests[0]
+            slots = [ slot for slot, f in enumerate(self._flagwords)
+                      if bool(f & m) is want ]
+        else:
+            slots = [ slot for slot, f in enumerate(self._flagwords)
+                      if all( bool(f & m) is want for m, want in tests ) ]
+        return [ self[wids[slot]] for slot in slots
+                 if wids[slot] is not None ]
+
+    def _get(self,wid):
+        """Return the window with id wid creating it if necessary"""
+        try:
+            return self[wid]
+        except KeyError:
+            w = _window(window=wid, iconified=False, shaded=False)
+            self[wid] = w
+            return w
+
+    def _update(self,p,**extra):
+        w   = self._get(p.window)
+        old = { key : w.get(key) for key in self._indexed }
+        for key, val in p.items():
+            if key in self._skipkeys: continue
+            ### Do not keep receive buffers alive (see m.zerocopy)
+            if isinstance(val,memoryview):
+                val = bytes(val)
+            w[key] = val
+        w.update(extra)
+        if p.ptype & ( M_CONFIGURE_WINDOW | M_ADD_WINDOW ):
+            w["page"]     = self._page(w)
+            w["winflags"] = windowflags(w["flags"])
+            self._setflags(p.window,w["winflags"])
+            if self.geometry is not None:
+                self.geometry.apply(p)
+        self._reindex(p.window,w,old)
+        return w
+
+    def _setflags(self,wid,flags):
+        try:
+            slot = self._slots[wid]
+        except KeyError:
+            if self._free:
+                slot = self._free.pop()
+                self._wids[slot] = wid
+            else:
+                slot = len(self._wids)
+                self._wids.append(wid)
+                self._flagwords.append(0)
+            self._slots[wid] = slot
+        self._flagwords[slot] = flags
+
+    def _page(self,w):
+        """Page (in the current desk) containing the center of w"""
+        width, height = self.screen
+        if not width or not height:
+            return None
+        vx, vy = self.viewport
+        return ( (vx + w["wx"] + w["wdx"]//2) // width,
+                 (vy + w["wy"] + w["wdy"]//2) // height )
+
+    def _reindex(self,wid,w,old):
+        for key, index in self._index.items():
+            val = w.get(key)
+            was = old.get(key)
+            if key in old and val == was:
+                continue
+            if key in old:
+                self._discard(index,was,wid)
+            try:
+                index[val].add(wid)
+            except KeyError:
+                index[val] = { wid }
+
+    def _unindex(self,wid,w):
+        for key, index in self._index.items():
+            self._discard(index,w.get(key),wid)
+        slot = self._slots.pop(wid,None)
+        if slot is not None:
+            ### withflags() skips free slots
+            self._wids[slot]      = None
+            self._flagwords[slot] = 0
+            self._free.append(slot)
+
+    def _ungeometry(self,wid):
+        ### only when the window leaves the database, replacing its
+        ### record keeps the geometry row
+        if self.geometry is not None:
+            self.geometry.remove(wid)
+
+    @staticmethod
+    def _discard(index,val,wid):
+        ws = index.get(val)
+        if ws is not None:
+            ws.discard(wid)
+            if not ws: del index[val]
+
+    def _new_page(self,p):
+        self.viewport = (p.px, p.py)
+        self.desk     = p.desk
+        self.screen   = (p.max_x, p.max_y)
+        self.pages    = (p.nx, p.ny)
+
+    def _new_desk(self,p):
+        self.desk = p.desk
+
+    def _destroy(self,p):
+        self.pop(p.window,None)
+
+    def _end(self,p):
+        self.complete = True
+
+    _appliers = {
+        M_NEW_PAGE:         _new_page,
+        M_NEW_DESK:         _new_desk,
+        M_DESTROY_WINDOW:   _destroy,
+        M_END_WINDOWLIST:   _end,
+        M_ICONIFY:          lambda self, p: self._update(p,iconified=True),
+        M_DEICONIFY:        lambda self, p: self._update(p,iconified=False),
+        M_WINDOWSHADE:      lambda self, p: self._update(p,shaded=True),
+        M_DEWINDOWSHADE:    lambda self, p: self._update(p,shaded=False),
+        }
+    for _ptype in split_mask(M_FOR_WINLIST & ~M_END_WINDOWLIST &
+                             ~M_DESTROY_WINDOW):
+        _appliers[_ptype] = _update
+    del _ptype
+
+    def filter(self,conditions,local=True):
         """Return an iterator cycling through windows satisfying
         conditions.
 
         conditions  -- a multi-line string containing condition as in 
         FVWM's conditional commands.
+
+        If local is True and the database is complete and maintained
+        (see maintained), conditions are evaluated without asking
+        FVWM, when it is possible (see fvwmpy.conditions).
         """
-        self._module.push_masks(M_STRING|M_ERROR,0,0)
-        cl = conditions.splitlines()
-        cl = map(lambda x: x.strip(" \t,"),cl)
-        cl = filter(None, cl)
-        cond = ",".join(cl)
-        self._module.debug( " Use condition {}",cond)
-        self._module.sendmessage(
-            "All ({}) SendToModule {} $[w.id]".
-            format(cond, self._module.alias), context_window = 0 )
-        self._module.sendmessage(
-            "SendToModule {} finishedfilterwindows".
-            format(self._module.alias), context_window = 0  )
+        found = self._local(conditions) if local else None
+        if found is not None:
+            yield from found
+            return
         filteredlist = list()
-        try:
+        with self._module.masks(M_STRING|M_ERROR,0,0):
+            self._ask(conditions)
             p = self._module.packets.read()
             self._module.debug( "Got {}",p.string )
             while p.ptype & M_STRING and p.string.startswith("0x"):
@@ -239,18 +496,83 @@ class _winlist(dict):
             if p.ptype & M_ERROR:
                 self._module.error("winlist: {}",p.string)
                 raise FvwmError(p.string)
-        finally:
-            self._module.restore_masks()
                    
         for wid in filteredlist:
             yield self[wid]
 
+    @property
+    def maintained(self):
+        """True if the database follows the changes in FVWM, i.e.
+        h_updatewl is registered for M_FOR_WINDB packets and the
+        module receives them.
+        """
+        m = self._module
+        return ( m.registered_handler(m.h_updatewl) & M_FOR_WINDB ==
+                 M_FOR_WINDB and m.mask & M_FOR_WINDB == M_FOR_WINDB )
+
+    def _local(self,conditions):
+        """Return the list of windows satisfying conditions or None,
+        if FVWM has to be asked.
+        """
+        if not self.complete or not self.maintained:
+            return None
+        match = compile_conditions(self._condition(conditions))
+        if match is None:
+            return None
+        try:
+            return [ w for w in self.values() if match(self,w) ]
+        except Undecidable as e:
+            self._module.debug("winlist: {}, ask FVWM",e)
+            return None
+
+    @staticmethod
+    def _condition(conditions):
+        cl = conditions.splitlines()
+        cl = map(lambda x: x.strip(" \t,"),cl)
+        cl = filter(None, cl)
+        return ",".join(cl)
+
+    def _ask(self,conditions):
+        """Ask FVWM to send ids of windows satisfying conditions"""
+        cond = self._condition(conditions)
+        self._module.debug( " Use condition {}",cond)
+        self._module.sendmessage(
+            "All ({}) SendToModule {} $[w.id]".
+            format(cond, self._module.alias), context_window = 0 )
+        self._module.sendmessage(
+            "SendToModule {} finishedfilterwindows".
+            format(self._module.alias), context_window = 0  )
+
     def __str__(self):
         res=list()
         for w in self.values():
             res.append(str(w))
         return "\n\n".join(res)
 
+### Parsers of config lines, see _config.register_parser()
+def _colorset(c,args,line):
+    cs = colorset(args)
+    c.set("colorsets",cs,cs.number)
+
+def _desktopsize(c,args,line):
+    c.set("DesktopSize",( int(args[0]), int(args[1]) ))
+
+def _imagepath(c,args,line):
+    c.set("ImagePath",tuple(args[0].split(":")))
+
+def _xineramaconfig(c,args,line):
+    c.set("XineramaConfig",tuple(map(int,args)))
+
+def _clicktime(c,args,line):
+    c.set("ClickTime",int(args[0]))
+
+def _ignoremodifiers(c,args,line):
+    c.set("IgnoreModifiers",tuple(map(int,args)))
+
+def _desktopname(c,args,line):
+    ### the name may contain spaces
+    c.set("DesktopNames",line.split(None,2)[2],int(args[0]))
+
 class _config(list):
     """Objects of this class contain configuration information
     supplied by FVWM in reply to Send_ConfigInfo command
@@ -263,19 +585,177 @@ class _config(list):
         c.XineramaConfig
         c.ClickTime
         c.IgnoreModifiers
+        c.DesktopNames
         c.colorsets
 
-    c.colorsets is a tuple if lists. Each list correspond to a colorset
+    c.colorsets is a list of fvwmpy.colorset objects (or None) indexed
+    by the number of the colorset.
+
+    c.ingest(line) dispatches the line to the parser registered for its
+    first word, see register_parser().
+
+    Changes are reported to callbacks added by c.subscribe(). Between
+    c.begin(match) and c.end() the config is reloaded: module lines,
+    that match and are not sent again, are removed at the end.
+    c.abort() stops the reload without removing anything.
     """
 
     _max_colorsets = int("0x40",16)
+    ### first word (lower case) -> parser
+    parsers  = { "colorset"        : _colorset,
+                 "desktopsize"     : _desktopsize,
+                 "imagepath"       : _imagepath,
+                 "xineramaconfig"  : _xineramaconfig,
+                 "clicktime"       : _clicktime,
+                 "ignoremodifiers" : _ignoremodifiers,
+                 "desktopname"     : _desktopname }
+    ### '*prefix' (lower case) -> parser, longer prefixes first
+    _options = dict()
+
     def __init__(self):
         self.DesktopSize  = (None, None)
         self.ImagePath = tuple()
         self.XineramaConfig = tuple()
         self.ClickTime = None
         self.IgnoreModifiers = tuple()
+        self.DesktopNames = dict()
         self.colorsets = [None for i in range(self._max_colorsets)]
+        ### attribute name (or None for all) -> callbacks
+        self._subscribers = dict()
+        ### module line -> number of its copies in the list
+        self._counts = dict()
+        ### while reloading: the prefix of lines to be pruned and
+        ### module line -> number of copies sent again
+        self._match  = None
+        self._seen   = None
+
+    @classmethod
+    def register_parser(cls,keyword,parser):
+        """Call parser(config,args,line) for every config line starting
+        with keyword (case insensitive). args is the list of the
+        following words.
+
+        If keyword starts with '*', it is a prefix of module
+        configuration lines, e.g. '*MyModule', and args[0] is the rest
+        of the first word, e.g. 'Geometry' for '*MyModuleGeometry 10x10'.
+        Such lines are also kept in the list.
+        """
+        keyword = keyword.lower()
+        if not keyword.startswith("*"):
+            cls.parsers[keyword] = parser
+            return
+        options = dict(cls._options)
+        options[keyword] = parser
+        cls._options = dict( sorted(options.items(),
+                                    key = lambda kv: -len(kv[0])) )
+
+    def ingest(self,line):
+        """Store the config line. Return False if there is no parser for
+        it. Exceptions raised by parsers are passed through.
+        """
+        args = line.split()
+        if not args:
+            return False
+        key  = args[0].lower()
+        if key.startswith("*"):
+            if self._seen is not None:
+                seen = self._seen[line] = self._seen.get(line,0) + 1
+                if seen <= self._counts.get(line,0):
+                    ### sent again, nothing changed
+                    return True
+            self.append(line)
+            self._counts[line] = self._counts.get(line,0) + 1
+            self._fire("lines",None,None,line)
+            for prefix, parser in self._options.items():
+                if key.startswith(prefix):
+                    args[0] = args[0][len(prefix):]
+                    parser(self,args,line)
+                    break
+            return True
+        parser = self.parsers.get(key)
+        if parser is None:
+            return False
+        parser(self,args[1:],line)
+        return True
+
+    def set(self,name,value,index=None):
+        """Set the attribute name (or its item index, if index is not
+        None) to value and tell subscribers, if the value changed.
+        Parsers should use it.
+        """
+        if index is None:
+            old = getattr(self,name,None)
+            if old == value: return
+            setattr(self,name,value)
+        else:
+            items = getattr(self,name)
+            if isinstance(items,list):
+                if index >= len(items):
+                    items.extend( None for i in range(index+1-len(items)) )
+                old = items[index]
+            else:
+                old = items.get(index)
+            if old == value: return
+            items[index] = value
+        self._fire(name,index,old,value)
+
+    def subscribe(self,callback,name=None):
+        """Call callback(name,index,old,new) when attribute name changes
+        (any attribute if name is None). index is the number of the
+        colorset or of the desk for colorsets and DesktopNames and None
+        otherwise. Module lines are reported as name 'lines' with old
+        or new being None, when a line is added or removed.
+        """
+        self._subscribers.setdefault(name,list()).append(callback)
+
+    def unsubscribe(self,callback,name=None):
+        try:
+            self._subscribers.get(name,list()).remove(callback)
+        except ValueError:
+            pass
+
+    def begin(self,match):
+        """Start reloading module lines starting with match"""
+        self._match = match.lower()
+        self._seen  = dict()
+
+    def abort(self):
+        """Stop the reload without removing any lines, e.g. when FVWM
+        did not send all of them. Does nothing if there is no reload.
+        """
+        self._match = self._seen = None
+
+    def end(self):
+        """Remove module lines matching the reload, that were not sent
+        again since begin(). Does nothing if there is no reload.
+        """
+        if self._seen is None:
+            return
+        match, seen = self._match, self._seen
+        self._match = self._seen = None
+        extra = dict()
+        for line, count in self._counts.items():
+            if line.lower().startswith(match) and count > seen.get(line,0):
+                extra[line] = count - seen.get(line,0)
+        if not extra:
+            return
+        ### drop the last copies
+        for i in range(len(self)-1,-1,-1):
+            line = self[i]
+            if extra.get(line):
+                extra[line] -= 1
+                del self[i]
+                self._counts[line] -= 1
+                if not self._counts[line]:
+                    del self._counts[line]
+                self._fire("lines",None,line,None)
+
+    def _fire(self,name,index,old,new):
+        subscribers = self._subscribers
+        if not subscribers: return
+        for callback in ( subscribers.get(name,[]) +
+                          subscribers.get(None,[]) ):
+            callback(name,index,old,new)
 
     def __str__(self):
         res = list()
@@ -285,6 +765,7 @@ class _config(list):
         res.append("  XineramaConfig = {}".format(self.XineramaConfig))
         res.append("  ClickTime = {}".format(self.ClickTime))
         res.append("  IgnoreModifiers = {}".format(self.IgnoreModifiers))
+        res.append("  DesktopNames = {}".format(self.DesktopNames))
         res.append("  colorsets:")
         for i, c in enumerate(self.colorsets):
             res.append("    {:x} = {}".format(i,c))
@@ -293,8 +774,35 @@ class _config(list):
             res.append("    "+cl)
         return "\n".join(res)
         
+### replies to fvwmpy._ask_delta()
+_delta_picker = picker(mask = M_STRING, string = Glob("snapshot*"))
+_delta_until  = picker(mask = M_STRING, string = Glob("snapshotdone *"))
+
 class fvwmpy:
     """Base class for developing Fvwm modules"""
+
+    ### class of packets created by the packet queue
+    packet_class = packet
+    ### packet bodies are memoryviews of the receive buffer
+    zerocopy     = False
+    ### send messages to FVWM right away, see batch()
+    autoflush    = True
+    ### keep m.winlist.geometry, see fvwmpy.geometry
+    columnar     = False
+    ### seconds after which the watchdog unlocks FVWM, see syncstats
+    syncdeadline = None
+    ### number of threads running worker handlers, see register_handler()
+    workers      = 4
+    ### types of packets, of which only the latest per window is
+    ### kept in the queue, e.g. M_CONFIGURE_WINDOW
+    coalesce     = 0
+    ### header of a message to FVWM: context window, length
+    _msghead     = _struct.Struct("LL")
+    ### classes of the helper objects, see fvwmpy.aio
+    _packet_queue_class = _packet_queue
+    _winlist_class      = _winlist
+    _fvwmvar_class      = _fvwmvar
+    _infostore_class    = _infostore
    
     def __init__(self):
         self.me     = _os.path.split(_sys.argv[0])[1]
@@ -324,21 +832,49 @@ class fvwmpy:
           self.warn,   self.error, self.critical  ) = _getloggers(self.alias)
         self.logger.setLevel(L_WARN)
 
-        self.handlers     = { pack : [] for pack in packetnames }
+        ### Dispatch table: packet type -> tuple of handlers in the order
+        ### of execution. It is rebuilt from _registry on every change.
+        self.handlers     = { pack : () for pack in packetnames }
+        ### packet type -> { handler : (-priority, sequence number) }
+        self._registry    = { pack : dict() for pack in packetnames }
+        ### handler -> mask of types it is registered for
+        self._registered  = dict()
+        ### handler -> mask of types it is registered once for
+        self._once        = dict()
+        ### handler -> mask of types it runs in the thread pool for
+        self._workers     = dict()
+        self._handler_seq = 0
+        ### window id -> (handler, packet) pairs waiting for a worker
+        self._serial      = dict()
+        self._serial_lock = _threading.Lock()
+        self._executor    = None
         ### We have to do that because mask.setter assumes 
         ### that _mask already exists.
         self._mask        = -1
         self._syncmask    = -1
         self._nograbmask  = -1
+        ### Masks as FVWM knows them, see _send_masks()
+        self._fvwm_masks  = (-1, -1, -1)
+        self._mask_lock   = _threading.RLock()
+        ### Encoded messages waiting to be written to FVWM. Masks go
+        ### through the buffer too, so one lock guards both.
+        self._outbuf      = list()
+        self._out_lock    = self._mask_lock
+        self._batch_depth = 0
+        ### Number of getreply() calls in progress
+        self._reply_leases = 0
+        ### FVWM is not yet told, that masks were restored
+        self._masks_stale  = False
         self.mask         = 0
         self.syncmask     = 0
         self.nograbmask   = 0
         self._mask_stack  = list()
-        self.winlist      = _winlist(self)
+        self.winlist      = self._winlist_class(self)
         self.config       = _config()
-        self.var          = _fvwmvar(self)
-        self.infostore    = _infostore(self)
-        self.packets      = _packet_queue(self)
+        self.var          = self._fvwmvar_class(self)
+        self.infostore    = self._infostore_class(self)
+        self.syncstats    = syncstats(self.syncdeadline,self._autounlock)
+        self.packets      = self._packet_queue_class(self)
         
     @property
     def alias(self):
@@ -369,21 +905,50 @@ class fvwmpy:
         lines = map( lambda x: x.strip(), msg.splitlines() )
         lines = filter(None,lines)
         lines = tuple(map(lambda l: l.encode(FVWM_STR_CODEX), lines))
-        cw   = _struct.pack("L",context_window)
-        for l in lines :
-            self._tofvwm.write( b''.join( (cw,
-                                           _struct.pack("L",len(l)),
-                                           l,
-                                           NOT_FINISHED) ) )
-            self.debug(" Send message {}",l)
-        if finished :
-            self._tofvwm.write(b''.join( (cw,
-                                          _struct.pack("L",3),
-                                          b'NOP',
-                                          FINISHED) ) )
-        self._tofvwm.flush()
+        head  = self._msghead.pack
+        with self._out_lock:
+            self._batch_depth += 1
+            try:
+                if self._masks_stale:
+                    self._send_masks()
+                out = self._outbuf
+                for l in lines :
+                    out.extend( (head(context_window,len(l)), l,
+                                 NOT_FINISHED) )
+                    self.debug(" Send message {}",l)
+                if finished :
+                    out.extend( (head(context_window,3), b'NOP', FINISHED) )
+            finally:
+                self._batch_depth -= 1
+            if self.autoflush and not self._batch_depth:
+                self.flush()
         self.sendmessage_hook(msg, context_window, finished)
 
+    def flush(self):
+        """Write all buffered messages to FVWM at once"""
+        with self._out_lock:
+            if not self._outbuf: return
+            data = b''.join(self._outbuf)
+            self._outbuf.clear()
+            self._tofvwm.write(data)
+            self._tofvwm.flush()
+
+    @_contextlib.contextmanager
+    def batch(self):
+        """Context manager. Messages sent inside the with block are
+        buffered and written to FVWM at once at the end of the outermost
+        batch. Methods, that wait for FVWM to reply, flush the buffer.
+        """
+        with self._out_lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._out_lock:
+                self._batch_depth -= 1
+                if self.autoflush and not self._batch_depth:
+                    self.flush()
+
     def finishedstartup(self):
         """
         Notify FVWM, that the module has finished configuring itself
@@ -397,6 +962,10 @@ class fvwmpy:
         """Exit from the module with exit status n"""
         
         self.unlock(finished=True)
+        if self._executor is not None:
+            ### exit() may be called by a worker handler, do not wait
+            self._executor.shutdown(wait=False,cancel_futures=True)
+        self.flush()
         self._tofvwm.close()
         self._fromfvwm.close()
         self.info(" Exit")
@@ -405,10 +974,33 @@ class fvwmpy:
     def unlock(self,finished=False):
         """
         Send "NOP UNLOCK" command to FVWM.
-        If finished=True, tell FVWM that the module will exit soon
+        If finished=True, tell FVWM that the module will exit soon.
+        FVWM is frozen until it gets it, so it is written at once
+        regardless of m.autoflush.
         """
         
-        self.sendmessage("NOP UNLOCK",finished)
+        token = self.syncstats.unlocking()
+        if not finished and token is None:
+            self.debug("unlock: already unlocked by the watchdog")
+            return
+        with self._out_lock:
+            self.sendmessage("NOP UNLOCK",finished=finished)
+            self.flush()
+        self.syncstats.unlocked(token)
+
+    def _synced(self,packs):
+        """Called by the packet queue with packets as they arrive"""
+        self.syncstats.arrived(packs,self._fvwm_masks[1])
+
+    def _autounlock(self,ptype,waited):
+        """Called by the watchdog of m.syncstats"""
+        try:
+            self.warn( "sync watchdog: {} is not unlocked after {:.3f}s, "+
+                       "unlock FVWM", packetnames[ptype], waited )
+            self.sendmessage("NOP UNLOCK")
+            self.flush()
+        except Exception as e:
+            self.error("sync watchdog: {}",repr(e))
 
     def mask_setter_hook(self, mask_type, m):
         """
@@ -433,9 +1025,7 @@ class fvwmpy:
         """
         if self._mask == m: return
         self._mask = m
-        ml = self._mask & ( M_EXTENDED_MSG - 1 )
-        mu = (self._mask >> 32) | M_EXTENDED_MSG
-        self.sendmessage("SET_MASK {}\nSET_MASK {}".format(ml,mu))
+        self._send_masks()
         self.mask_setter_hook("mask",m)
 
     @property
@@ -449,9 +1039,7 @@ class fvwmpy:
     def syncmask(self,m):
         if self._syncmask == m: return
         self._syncmask = m 
-        ml = self._syncmask & ( M_EXTENDED_MSG - 1 )
-        mu = (self._syncmask >> 32) | M_EXTENDED_MSG
-        self.sendmessage("SET_SYNC_MASK {}\nSET_SYNC_MASK {}".format(ml,mu))
+        self._send_masks()
         self.mask_setter_hook("syncmask",m)
         
     @property
@@ -464,11 +1052,72 @@ class fvwmpy:
     def nograbmask(self,m):
         if self._nograbmask == m: return
         self._nograbmask = m
-        ml = self._nograbmask & ( M_EXTENDED_MSG - 1 )
-        mu = (self._nograbmask >> 32) | M_EXTENDED_MSG
-        self.sendmessage( "SET_NOGRAB_MASK {}\nSET_NOGRAB_MASK {}".
-                          format(ml,mu))
-        self.mask_setter_hook("syncmask",m)
+        self._send_masks()
+        self.mask_setter_hook("nograbmask",m)
+
+    def _send_masks(self,defer=False):
+        """Notify FVWM of the masks in effect, if they changed.
+        While getreply() is waiting for the reply MX_REPLY is added to
+        mask and syncmask and nograbmask are 0.
+
+        All changes go in one message. If defer is True, FVWM is
+        notified only before the next message is sent to it or the
+        module waits for packets, so that the change may cancel out
+        with the next one.
+        """
+        with self._mask_lock:
+            if defer:
+                self._masks_stale = True
+                return
+            self._masks_stale = False
+            if self._reply_leases:
+                masks = ( self._mask | MX_REPLY, 0, 0 )
+            else:
+                masks = ( self._mask, self._syncmask, self._nograbmask )
+            lines = list()
+            for cmd, new, old in zip(
+                    ("SET_MASK", "SET_SYNC_MASK", "SET_NOGRAB_MASK"),
+                    masks, self._fvwm_masks ):
+                if new == old: continue
+                ml = new & ( M_EXTENDED_MSG - 1 )
+                mu = (new >> 32) | M_EXTENDED_MSG
+                lines.append("{0} {1}\n{0} {2}".format(cmd,ml,mu))
+            if lines:
+                self.sendmessage("\n".join(lines))
+            self._fvwm_masks = masks
+
+    def _idle(self):
+        """Called by the packet queue before waiting for packets"""
+        with self._out_lock:
+            if self._masks_stale:
+                self._send_masks()
+            self.flush()
+
+    def _lease_reply(self):
+        "Make FVWM send MX_REPLY packets until _release_reply()"
+        with self._mask_lock:
+            self._reply_leases += 1
+            if self._reply_leases == 1: self._send_masks()
+
+    def _release_reply(self):
+        with self._mask_lock:
+            self._reply_leases -= 1
+            if self._reply_leases: return
+            ### as in restore_masks() only a change of mask may wait
+            defer = ( (self._syncmask, self._nograbmask) ==
+                      self._fvwm_masks[1:] )
+            self._send_masks(defer)
+            if not defer: self.flush()
+
+    def _set_masks(self,masks,defer=False):
+        """Assign all three masks at once, notify FVWM once"""
+        with self._mask_lock:
+            old = ( self._mask, self._syncmask, self._nograbmask )
+            self._mask, self._syncmask, self._nograbmask = masks
+            self._send_masks(defer)
+        for mask_type, m, o in zip( ("mask","syncmask","nograbmask"),
+                                    masks, old ):
+            if m != o: self.mask_setter_hook(mask_type,m)
 
     def push_masks(self,mask,syncmask,nograbmask):
         "Temporarily assign new values to masks"
@@ -476,39 +1125,115 @@ class fvwmpy:
         if syncmask   is None: syncmask   = self.syncmask
         if nograbmask is None: nograbmask = self.nograbmask
         self._mask_stack.append( (self.mask,self.syncmask,self.nograbmask) )
-        self.mask, self.syncmask, self.nograbmask = (
-            mask, syncmask, nograbmask ) 
+        ### FVWM learns the new masks together with the next message
+        self._set_masks( (mask, syncmask, nograbmask), defer=True )
         
     def restore_masks(self):
-        "Restore previous values of masks"
+        """Restore previous values of masks. FVWM is notified lazily,
+        see masks()
+        """
         try:
-           self.mask, self.syncmask, self.nograbmask = self._mask_stack.pop() 
+            masks = self._mask_stack.pop()
         except IndexError:
             raise IllegalOperation(
                 "Can not restore masks. Mask stack is empty" )
+        ### FVWM must not be left with zero syncmask or nograbmask
+        ### while the module idles in read() with a full queue, so
+        ### their restore is sent right away
+        with self._mask_lock:
+            defer = ( bool(self._reply_leases) or
+                      masks[1:] == self._fvwm_masks[1:] )
+            self._set_masks(masks,defer)
+            ### regardless of m.autoflush
+            if not defer: self.flush()
+
+    @_contextlib.contextmanager
+    def masks(self,mask=None,syncmask=None,nograbmask=None):
+        """Context manager. Temporarily assign new values to masks
+        (None means no change) and restore them at the end.
+
+        FVWM is told about all three masks in one message. The restore
+        of mask alone is sent only before the next message to FVWM or
+        when the module waits for packets, so back to back or nested
+        transactions, that end up with the same masks, do not bother
+        FVWM at all. The restore of syncmask or nograbmask is sent
+        immediately.
+        """
+        self.push_masks(mask,syncmask,nograbmask)
+        try:
+            yield self
+        finally:
+            self.restore_masks()
 
     def getreply(self,msg,context_window=None,timeout=0.5):
         """Send a string to FVWM in context context_window
         get the reply and return it
         """
+        ### The reply resolves the future in the reader thread and
+        ### never enters the queue, so getreply may be called from
+        ### several threads at once, also while run() reads the queue
+        f, = self.sendreplies(msg,context_window=context_window)
+        self.flush()
+        _futures.wait((f,),timeout)
+        if f.cancel():
+            self.warn( "getreply: didn't get any reply from FVWM, return None")
+            return
+        return f.result()
+
+    def sendreplies(self,*msgs,context_window=None):
+        """Ask FVWM to reply to all msgs at once and return the list of
+        concurrent.futures.Future objects, one for every message, which
+        are resolved to the replies as they arrive. Futures, that are no
+        longer needed, should be cancelled.
+        """
         if context_window is None:
             context_window = self.context_window
-        uid = unique_id()
-        self.push_masks(self.mask|MX_REPLY,0,0)
+        futures = list()
+        lines   = list()
         try:
-            self.sendmessage( "Send_Reply {}{}".format(uid,msg),
-                              context_window = context_window)
-            replypicker = picker(mask = MX_REPLY,string =Glob(uid+"*") )
-            packs = self.packets.pick(picker=picker(mask = MX_REPLY,
-                                                  string =Glob(uid+"*") ),
-                                    timeout=timeout)
-        finally:
-            self.restore_masks()
-        if not packs:
-            self.warn( "getreply: didn't get any reply from FVWM, return None")
-            return
-        else:
-            return packs[0].string.replace(uid,"")
+            for msg in msgs:
+                uid = unique_id()
+                f   = _futures.Future()
+                self.packets._expect(uid,f)
+                self._lease_reply()
+                f.add_done_callback(
+                    lambda f, uid=uid: self._reply_done(uid) )
+                futures.append(f)
+                lines.append("Send_Reply {}:{}".format(uid,msg))
+            if lines:
+                self.sendmessage( "\n".join(lines),
+                                  context_window=context_window )
+        except BaseException:
+            for f in futures:
+                f.cancel()
+            raise
+        return futures
+
+    def _reply_done(self,uid):
+        self.packets._forget(uid)
+        self._release_reply()
+
+    def getreplies(self,*msgs,context_window=None,timeout=0.5):
+        """Send all msgs to FVWM in context context_window in one go,
+        wait for the replies for at most timeout seconds and return the
+        list of them. Missing replies are None.
+        """
+        futures = self.sendreplies(*msgs,context_window=context_window)
+        self.flush()
+        _futures.wait(futures,timeout)
+        return self._collect(futures)
+
+    def _collect(self,futures):
+        replies = list()
+        for f in futures:
+            if f.cancel():
+                replies.append(None)
+            else:
+                replies.append(f.result())
+        if None in replies:
+            self.warn( "getreplies: {} replies from FVWM are missing",
+                       replies.count(None) )
+        return replies
 
     def getconfig(self, handler=None, match=None, timeout=0.5):
         """Ask FVWM for module configuration information matching
@@ -517,88 +1242,331 @@ class fvwmpy:
         """
 
         if match is None: match   = "*" + self.alias
-        ### Ask first
-        self.push_masks(self.mask|M_FOR_CONFIG,0,0)
+        reload = handler is None
         try:
-            self.sendmessage("Send_ConfigInfo {}".format(match))
-            if handler is None:
-                handler = self.h_saveconfig
-                self.info("getconfig: standard handler")
-                self.config    = _config()
-                self.rawconfig = list()
-            packs = self.packets.pick( picker = picker(mask=M_FOR_CONFIG),
-                                       until  = picker(mask=M_END_CONFIG_INFO),
-                                       timeout = timeout )
-            self.info( "getconfig: got {} config packets",len(packs))
+            ### Ask first
+            with self.masks(self.mask|M_FOR_CONFIG,0,0):
+                self.sendmessage("Send_ConfigInfo {}".format(match))
+                if reload:
+                    handler = self.h_saveconfig
+                    self.info("getconfig: standard handler")
+                    ### only changes are applied, see _config.begin()
+                    self.config.begin(match)
+                    self.rawconfig = list()
+                packs = self.packets.pick(
+                    picker  = picker(mask=M_FOR_CONFIG),
+                    until   = picker(mask=M_END_CONFIG_INFO),
+                    timeout = timeout )
+                self.info( "getconfig: got {} config packets",len(packs))
+            for p in packs:
+                handler(p)
         finally:
-            self.restore_masks()
-        for p in packs:
-            handler(p)
+            ### h_saveconfig() ends the reload on M_END_CONFIG_INFO,
+            ### without it nothing is pruned
+            if reload: self.config.abort()
         return packs[-1].ptype == M_END_CONFIG_INFO
             
     def getwinlist(self, handler = None, timeout=0.5):
         """Ask FVWM for the list of all windows.
         Pass replies to handler (h_updatewl if handler==None)
         """
+        handler, mask = self._winlist_handler(handler)
         ### Ask FVWM first
-        self.push_masks(self.mask|M_FOR_WINLIST,0,0)
-        try:
+        with self.masks(self.mask|mask,0,0):
             self.sendmessage("Send_WindowList")
-            if handler is None:
-                handler = self.h_updatewl
-                self.winlist.clear()
-            packs = self.packets.pick( picker = picker(mask = M_FOR_WINLIST),
+            packs = self.packets.pick( picker = picker(mask = mask),
                                        until  = picker(mask = M_END_WINDOWLIST),
                                        timeout = timeout )
             self.info( "getwinlist: got {} winlist packets",
                        len(packs))
-        finally:
-            self.restore_masks()
         for p in packs:
             handler(p)
         return packs[-1].ptype == M_END_WINDOWLIST
     
-    def register_handler(self,mask,handler):
-        """Add handler to the end of execution queues for all packets 
-        matching mask.
+    def savesnapshot(self,path=None):
+        """Save m.winlist and m.config to the snapshot file, so that
+        modules started later by the same FVWM can use loadsnapshot().
+        """
+        _snapshot.save(self.winlist,self.config,self.alias,path)
+        self.info("savesnapshot: saved {} windows",len(self.winlist))
+
+    def loadsnapshot(self,path=None,config=True,reconcile=True,timeout=0.5):
+        """Fill m.winlist (and m.config if config is True) from the
+        snapshot saved by savesnapshot(). Return False if there is no
+        snapshot for this FVWM. If the snapshot was saved by another
+        module, module lines are taken from FVWM with getconfig().
+
+        If reconcile is True, FVWM is asked for the id, position, size,
+        desk, layer, names, state and flags of every window (see
+        snapshot.fingerprint()). Windows, that are gone, are removed
+        from the winlist. If there are new or changed windows, or
+        windowflags.bits has flags FVWM can not be asked about, the
+        winlist is refreshed with getwinlist(). In the same round trip
+        the restored config is checked (see snapshot.config_fingerprint())
+        and refreshed with getconfig() if it is out of date.
+        """
+        restored = self._restore_snapshot(path,config)
+        if restored is None:
+            return False
+        colorsets, fetch = restored
+        if fetch:
+            self.getconfig(timeout=timeout)
+        if not reconcile:
+            return True
+        flags = self._delta_flags()
+        if flags is None and colorsets is None:
+            return self.getwinlist(timeout=timeout)
+        with self.masks(M_STRING|M_ERROR,0,0):
+            self._ask_delta(flags,colorsets)
+            packs = self.packets.pick( picker  = _delta_picker,
+                                       until   = _delta_until,
+                                       timeout = timeout )
+        delta = self._parse_delta(packs,colorsets)
+        if not self._config_fresh(delta,colorsets):
+            self.getconfig(timeout=timeout)
+        if not self._apply_delta(delta,flags):
+            return self.getwinlist(timeout=timeout)
+        return True
+
+    def _restore_snapshot(self,path,config):
+        """Fill the databases from the snapshot. Return None if there is
+        no snapshot, otherwise (colorsets, fetch). colorsets are the
+        numbers of the colorsets to check with FVWM (None if config is
+        not taken from the snapshot), fetch tells if config has to be
+        asked from FVWM.
+        """
+        data = _snapshot.load(path)
+        if data is None:
+            self.info("loadsnapshot: no snapshot")
+            return None
+        _snapshot.restore_winlist(self.winlist,data,_window)
+        if not config:
+            return None, False
+        if not _snapshot.restore_config(self.config,data,self.alias):
+            self.info("loadsnapshot: saved by {}, ask FVWM for config",
+                      data["alias"])
+            return None, True
+        return tuple( cs[0] for cs in data["colorsets"]
+                      if cs is not None ), False
+
+    def _delta_flags(self):
+        """Flags to ask FVWM about or None if the restored flags can not
+        be checked
+        """
+        flags = _snapshot.delta_flags()
+        if flags is None:
+            self.info("loadsnapshot: windowflags can not be checked, "
+                      "refresh the winlist")
+        return flags
+
+    def _ask_delta(self,flags,colorsets):
+        """Ask FVWM for what snapshot.fingerprint() tells about windows
+        and snapshot.config_fingerprint() tells about config.
+        """
+        for cmd in _snapshot.delta_query(self.alias,flags,colorsets):
+            self.sendmessage(cmd,context_window=0)
+
+    def _parse_delta(self,packs,colorsets):
+        """Parse the reply to _ask_delta(). Return None if there is no
+        usable reply.
+        """
+        if not packs or not packs[-1].string.startswith("snapshotdone "):
+            self.warn("loadsnapshot: FVWM did not reply")
+            return None
+        try:
+            return _snapshot.parse_delta(
+                [ p.string.strip() for p in packs ], colorsets )
+        except (ValueError, IndexError) as e:
+            self.warn("loadsnapshot: can not parse the reply: {}",repr(e))
+            return None
+
+    def _config_fresh(self,delta,colorsets):
+        """Return False if the restored config has to be refreshed"""
+        if colorsets is None:
+            return True
+        if ( delta is not None and delta[3] ==
+             _snapshot.config_fingerprint(self.config,colorsets) ):
+            return True
+        self.info("loadsnapshot: config is out of date, refresh it")
+        return False
+
+    def _apply_delta(self,delta,flags):
+        """Reconcile the winlist with the parsed reply. Return False if
+        the winlist has to be refreshed from FVWM.
+        """
+        if delta is None or flags is None:
+            return False
+        wl = self.winlist
+        desk, viewport, current, cfg = delta
+        wl.desk, wl.viewport = desk, viewport
+        for wid in [ wid for wid in wl if wid not in current ]:
+            del wl[wid]
+        for wid, w in current.items():
+            if ( wid not in wl or _snapshot.fingerprint(wl[wid],flags) !=
+                 _snapshot.fingerprint(w,flags) ):
+                self.info("loadsnapshot: window 0x{:x} changed",wid)
+                return False
+        self.info("loadsnapshot: {} windows are up to date",len(wl))
+        return True
+
+    def _winlist_handler(self,handler):
+        """Return the handler and the mask of packets for getwinlist()"""
+        if handler is None:
+            self.winlist.clear()
+            ### FVWM also tells the current desk and page and which
+            ### windows are iconified
+            return self.h_updatewl, M_FOR_WINDB
+        return handler, M_FOR_WINLIST
+
+    def register_handler(self,mask,handler,priority=0,once=False,
+                         worker=False):
+        """Add handler to the execution queues for all packets matching
+        mask. Handlers with higher priority are executed first, those
+        with equal priority in the order they were registered.
+
+        If once is True, handler is unregistered from these queues
+        before it is called for the first time.
+
+        If worker is True, handler is called in a thread pool of
+        m.workers threads and call_handlers() does not wait for it.
+        Worker handlers are called for packets of the same window one
+        after another in the order of the packets.
         """
-        for m in self.handlers:
-            if (m & mask) and not (handler in self.handlers[m]):
-                self.handlers[m].append(handler)
+        mask &= ~self._registered.get(handler,0)
+        if not mask: return
+        self._handler_seq += 1
+        key = (-priority, self._handler_seq)
+        for ptype, entries in self._registry.items():
+            if ptype & mask:
+                entries[handler] = key
+                self._rebuild(ptype)
+        self._registered[handler] = self._registered.get(handler,0) | mask
+        if once:
+            self._once[handler] = self._once.get(handler,0) | mask
+        if worker:
+            self._workers[handler] = self._workers.get(handler,0) | mask
 
     def unregister_handler(self,mask,handler):
         """Remove handler from all execution queues for packets matching 
         masks. If handler is not in a queue, do nothing.
         """
-        for m in self.handlers:
-            if (m & mask):
-                try:
-                    self.handlers[m].remove(handler)
-                except ValueError:
-                    continue
+        registered = self._registered.get(handler,0)
+        mask &= registered
+        if not mask: return
+        for ptype, entries in self._registry.items():
+            if ptype & mask:
+                del entries[handler]
+                self._rebuild(ptype)
+        self._forget_handler(self._registered,handler,mask)
+        self._forget_handler(self._once,handler,mask)
+        self._forget_handler(self._workers,handler,mask)
 
     def call_handlers(self,p):
         """Execute all handlers in the queue for the packet p passing p as an 
-        argument in the order they were registered.
+        argument in the order of their priority and registration.
         """
-        for h in self.handlers[p.ptype]:
+        start   = _time.perf_counter()
+        for h in self._dispatch(p):
             h(p)
+        self.packets.metrics._handled(p.ptype,_time.perf_counter()-start)
+
+    def _dispatch(self,p):
+        """Yield the handlers for the packet p, that the caller has to
+        call, in the order of execution. Handlers registered once are
+        unregistered and worker handlers are submitted to the pool on
+        the way.
+        """
+        once    = self._once
+        workers = self._workers
+        for h in self.handlers[p.ptype]:
+            ### unregister_handler() forgets the worker bit too
+            worker = workers and workers.get(h,0) & p.ptype
+            if once and h in once:
+                self.unregister_handler(once[h],h)
+            if worker:
+                self._submit(h,p)
+            else:
+                yield h
         
     def clear_handlers(self,mask):
         """Clear all queues for packets matching mask."""
-        for h in self.handlers[p.ptype]:
-            if h & mask:
-                self.handlers[p.ptype] = list()
+        for handler in list(self._registered):
+            self.unregister_handler(mask,handler)
          
     def registered_handler(self,handler):
         """Return the mask matching all packet types for which handler 
         is registered.
         """
-        mask = 0
-        for m in self.handlers:
-            if handler in self.handlers[m]:
-                mask |= m
-        return mask
+        return self._registered.get(handler,0)
+
+    def _submit(self,h,p):
+        """Call h(p) in the thread pool after the worker handlers
+        submitted earlier for the same window.
+        """
+        key = p.get("window")
+        with self._serial_lock:
+            pending = self._serial.get(key)
+            if pending is not None:
+                pending.append( (h, p) )
+                return
+            self._serial[key] = _collections.deque( ((h, p),) )
+            if self._executor is None:
+                self._executor = _futures.ThreadPoolExecutor(
+                    max_workers        = self.workers,
+                    thread_name_prefix = self.alias+":worker" )
+        try:
+            self._executor.submit(self._drain,key)
+        except RuntimeError:
+            ### the pool is shut down, e.g. by exit()
+            with self._serial_lock:
+                del self._serial[key]
+            raise
+
+    def _drain(self,key):
+        """Run worker handlers for the window key until none is left"""
+        pending = self._serial[key]
+        done    = False
+        try:
+            while not done:
+                h, p = pending[0]
+                try:
+                    self._work(h,p)
+                except Exception as e:
+                    self.error("worker: {} failed on {}: {}",
+                               h,p.name,repr(e))
+                finally:
+                    with self._serial_lock:
+                        pending.popleft()
+                        done = not pending
+                        if done:
+                            del self._serial[key]
+        except BaseException:
+            ### the rest of the handlers of the window run in a new task
+            with self._serial_lock:
+                if not done and self._serial.get(key) is pending:
+                    try:
+                        self._executor.submit(self._drain,key)
+                    except RuntimeError as e:
+                        self.error("worker: {} handlers are dropped: {}",
+                                   len(pending),repr(e))
+                        del self._serial[key]
+            raise
+
+    def _work(self,h,p):
+        """Call the worker handler h in the pool thread"""
+        h(p)
+
+    def _rebuild(self,ptype):
+        entries = self._registry[ptype]
+        self.handlers[ptype] = tuple(sorted(entries,key=entries.__getitem__))
+
+    @staticmethod
+    def _forget_handler(masks,handler,mask):
+        rest = masks.get(handler,0) & ~mask
+        if rest:
+            masks[handler] = rest
+        else:
+            masks.pop(handler,None)
     
             
     ### HANDLERS
@@ -609,7 +1577,9 @@ class fvwmpy:
         config database.
         If packet p has wrong type IllegalOperation exception is raised.
         """
-        if p.ptype == M_END_CONFIG_INFO: return
+        if p.ptype == M_END_CONFIG_INFO:
+            self.config.end()
+            return
         if not p.ptype & M_FOR_CONFIG:
             raise IllegalOperation(
                 "h_saveconfig: Packet must have type matching M_FOR_CONFIG" )
@@ -618,28 +1588,14 @@ class fvwmpy:
         ### For debugging DON'T FORGET!!!
         # self.rawconfig.append(p.string)
         
-        if p.string == glob("[*]*"):
-            self.config.append(p.string)
-        elif p.string == glob("colorset *"):
-            ### ToDo: parse colorsets
-            cll = p.string.split()
-            self.config.colorsets[int(cll[1],16)]=cll[2:]
-        elif p.string == glob("desktopsize *"):
-            cll = p.string.split()
-            self.config.DesktopSize = ( int(cll[1]), int(cll[2]) )
-        elif p.string == glob("imagepath *"):
-            paths =  p.string.split()[1].strip().split(":")
-            self.config.ImagePath   = tuple(paths)
-        elif p.string == glob("xineramaconfig *"):
-            cll = p.string.split()[1:]
-            self.config.XineramaConfig = tuple(map(int,cll))
-        elif p.string == glob("clicktime *"):
-            self.config.ClickTime = int(p.string.split()[1])
-        elif p.string == glob("ignoremodifiers *"):
-            cll = p.string.split()[1:]
-            self.config.IgnoreModifiers = tuple(map(int, cll))
-        else:
-            FvwmError("Can not parse the packet: {}".format(p.string))
+        try:
+            ### FVWM sends lines nobody parses (e.g. MoveThreshold,
+            ### ColorLimit), they are no news
+            if not self.config.ingest(p.string):
+                self.debug("h_saveconfig: unknown config line: {}",p.string)
+        except (ValueError, IndexError) as e:
+            self.error( "h_saveconfig: can not parse {}: {}",
+                        p.string, repr(e) )
             
     def h_unlock(self, p):
         """Handler. Packet types: M_ALL.
@@ -651,27 +1607,15 @@ class fvwmpy:
         
     ### Update winlist
     def h_updatewl(self,p):
-        """Handler. Packet types: M_FOR_WINLIST | M_DESTROY_WINDOW
+        """Handler. Packet types: M_FOR_WINDB
 
         This handler updates the winlist database with the information in the 
         packet p.
         """
-        if p.ptype & M_END_WINDOWLIST: return
-        if not p.ptype & M_FOR_WINLIST | M_DESTROY_WINDOW:
+        if not p.ptype & M_FOR_WINDB:
             raise IllegalOperation(
-                "h_updatewl: Packet must have type matching " +
-                "M_FOR_WINLIST or M_DESTROY_WINDOW" )
-        if p.ptype == M_DESTROY_WINDOW:
-            try:               del self.winlist[p.window]
-            except KeyError(): pass
-        else:
-            if p.window not in self.winlist:
-                self.winlist[p.window] = _window()
-            up = dict(p)
-            for key in {"body","ptype","time"}:
-                try:             del up[key]
-                except KeyError: pass
-            self.winlist[p.window].update(up)
+                "h_updatewl: Packet must have type matching M_FOR_WINDB" )
+        self.winlist.apply(p)
 
     def h_exit(self,p):
         """Handler. Packet types: M_ALL.
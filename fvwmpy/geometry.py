@@ -0,0 +1,202 @@
+import array
+
+from   .constants import M_CONFIGURE_WINDOW, M_ADD_WINDOW, M_DESTROY_WINDOW
+
+try:
+    import numpy as _np
+except ImportError:
+    _np = None
+
+def xinerama_screens(config):
+    """Return the list of (x, y, width, height) rectangles of Xinerama
+    screens from config.XineramaConfig (see fvwmpy._config). The
+    rectangles are the trailing groups of four numbers, whatever
+    precedes them is FVWM's own settings.
+    """
+    vals = config.XineramaConfig
+    vals = vals[len(vals) % 4:]
+    return [ tuple(vals[i:i+4]) for i in range(0,len(vals),4) ]
+
+_long_bits = 8 * array.array("l").itemsize
+
+def _signed(v):
+    """Unsigned long v as a signed one"""
+    return v - (1 << _long_bits) if v >= 1 << (_long_bits - 1) else v
+
+class geometry:
+    """Columnar store of window geometry.
+
+    g = geometry()
+
+    Keeps wx, wy, wdx, wdy, desk and layer of every window in
+    array.array columns g.wx, g.wy, ... Row i of the columns belongs to
+    the window g.wids[i], g.row(wid) is the row of the window wid. If
+    numpy is available (and use_numpy is not False), queries are
+    vectorized with numpy, otherwise they are done in pure python.
+
+    g.update(wid,wx,wy,wdx,wdy,desk,layer) and g.remove(wid) change the
+    store, g.apply(p) does it from M_CONFIGURE_WINDOW, M_ADD_WINDOW and
+    M_DESTROY_WINDOW packets. With m.columnar = True m.winlist.geometry
+    is kept up to date by m.winlist.
+
+    The columns must not be resized by anybody else. Numpy arrays
+    returned by g.column() must be released before the next update.
+    """
+
+    columns = ( "wx", "wy", "wdx", "wdy", "desk", "layer" )
+
+    def __init__(self,use_numpy=None):
+        if use_numpy and _np is None:
+            raise ImportError("numpy is not available")
+        self.numpy = _np is not None if use_numpy is None else use_numpy
+        self.wids  = array.array("Q")
+        for col in self.columns:
+            setattr(self,col,array.array("l"))
+        self._rows = dict()
+
+    def __len__(self):
+        return len(self.wids)
+
+    def __contains__(self,wid):
+        return wid in self._rows
+
+    def row(self,wid):
+        return self._rows[wid]
+
+    def column(self,name):
+        """Numpy view of the column name (no copy)"""
+        col = getattr(self,name)
+        return _np.frombuffer(col,dtype=col.typecode)
+
+    def get(self,wid):
+        """Return (wx, wy, wdx, wdy, desk, layer) of the window wid"""
+        row = self._rows[wid]
+        return tuple( getattr(self,col)[row] for col in self.columns )
+
+    def update(self,wid,wx,wy,wdx,wdy,desk,layer):
+        ### FVWM sends desk and layer as unsigned longs, desk may be
+        ### negative. The row is checked before anything is stored, so
+        ### that the columns stay aligned.
+        vals = array.array( "l", ( wx, wy, wdx, wdy,
+                                   _signed(desk), _signed(layer) ) )
+        row  = self._rows.get(wid)
+        if row is None:
+            ### raises before the row is added, if wid does not fit
+            array.array("Q",(wid,))
+            for col, val in zip(self.columns,vals):
+                getattr(self,col).append(val)
+            self._rows[wid] = len(self.wids)
+            self.wids.append(wid)
+        else:
+            for col, val in zip(self.columns,vals):
+                getattr(self,col)[row] = val
+
+    def remove(self,wid):
+        """Remove the window. The last row takes its place."""
+        row = self._rows.pop(wid,None)
+        if row is None:
+            return
+        last = len(self.wids) - 1
+        cols = ( self.wids, ) + tuple( getattr(self,c) for c in self.columns )
+        if row != last:
+            for col in cols:
+                col[row] = col[last]
+            self._rows[self.wids[row]] = row
+        for col in cols:
+            del col[last]
+
+    def clear(self):
+        self._rows.clear()
+        for col in ( "wids", ) + self.columns:
+            del getattr(self,col)[:]
+
+    def apply(self,p):
+        if p.ptype & ( M_CONFIGURE_WINDOW | M_ADD_WINDOW ):
+            self.update( p.window, p.wx, p.wy, p.wdx, p.wdy,
+                         p.desk, p.layer )
+        elif p.ptype & M_DESTROY_WINDOW:
+            self.remove(p.window)
+
+    def intersecting(self,x,y,dx,dy,desk=None):
+        """Return ids of windows intersecting the rectangle x, y, dx, dy
+        (on desk, if it is not None).
+        """
+        if self.numpy:
+            X, Y, DX, DY, D = map( self.column,
+                                   ("wx", "wy", "wdx", "wdy", "desk") )
+            sel = (X < x + dx) & (X + DX > x) & (Y < y + dy) & (Y + DY > y)
+            if desk is not None:
+                sel &= D == desk
+            return [ self.wids[i] for i in _np.flatnonzero(sel).tolist() ]
+        X, Y, DX, DY, D = self.wx, self.wy, self.wdx, self.wdy, self.desk
+        return [ self.wids[i] for i in range(len(self.wids))
+                 if ( X[i] < x + dx and X[i] + DX[i] > x and
+                      Y[i] < y + dy and Y[i] + DY[i] > y and
+                      ( desk is None or D[i] == desk ) ) ]
+
+    def overlapping(self,wid):
+        """Return ids of windows on the same desk overlapping the window
+        wid.
+        """
+        wx, wy, wdx, wdy, desk, layer = self.get(wid)
+        return [ w for w in self.intersecting(wx,wy,wdx,wdy,desk)
+                 if w != wid ]
+
+    def overlaps(self):
+        """Return the list of pairs of ids of overlapping windows (on the
+        same desk).
+        """
+        if self.numpy:
+            X, Y, DX, DY, D = map( self.column,
+                                   ("wx", "wy", "wdx", "wdy", "desk") )
+            X2, Y2 = X + DX, Y + DY
+            m = ( ( X[:,None] < X2[None,:] ) & ( X2[:,None] > X[None,:] ) &
+                  ( Y[:,None] < Y2[None,:] ) & ( Y2[:,None] > Y[None,:] ) &
+                  ( D[:,None] == D[None,:] ) )
+            i, j = _np.nonzero(_np.triu(m,1))
+            wids = self.wids
+            return [ (wids[a], wids[b])
+                     for a, b in zip(i.tolist(),j.tolist()) ]
+        ### sweep along x
+        X, Y, DX, DY, D = self.wx, self.wy, self.wdx, self.wdy, self.desk
+        pairs  = list()
+        active = list()
+        for r in sorted(range(len(self.wids)),key=X.__getitem__):
+            x = X[r]
+            active = [ a for a in active if X[a] + DX[a] > x ]
+            for a in active:
+                if ( D[a] == D[r] and X[r] + DX[r] > X[a] and
+                     Y[a] < Y[r] + DY[r] and Y[a] + DY[a] > Y[r] ):
+                    a, b = sorted( (a, r) )
+                    pairs.append( (self.wids[a], self.wids[b]) )
+            active.append(r)
+        return pairs
+
+    def screens(self,rects,desk=None):
+        """Group windows by screens. rects is the list of (x, y, width,
+        height) of the screens (see xinerama_screens()). Return the
+        list of lists of ids of windows, whose center is on the
+        corresponding screen.
+        """
+        if self.numpy:
+            X, Y, DX, DY, D = map( self.column,
+                                   ("wx", "wy", "wdx", "wdy", "desk") )
+            CX, CY = X + DX // 2, Y + DY // 2
+            groups = list()
+            for x, y, w, h in rects:
+                sel = (CX >= x) & (CX < x + w) & (CY >= y) & (CY < y + h)
+                if desk is not None:
+                    sel &= D == desk
+                groups.append( [ self.wids[i] for i in
+                                 _np.flatnonzero(sel).tolist() ] )
+            return groups
+        groups = [ list() for r in rects ]
+        X, Y, DX, DY, D = self.wx, self.wy, self.wdx, self.wdy, self.desk
+        for i in range(len(self.wids)):
+            if desk is not None and D[i] != desk: continue
+            cx, cy = X[i] + DX[i] // 2, Y[i] + DY[i] // 2
+            for group, (x, y, w, h) in zip(groups,rects):
+                if x <= cx < x + w and y <= cy < y + h:
+                    group.append(self.wids[i])
+                    break
+        return groups
@@ -33,6 +33,308 @@ def _unpack(fmt,body,offset):
     x = struct.unpack_from(fmt,body,offset)
     return x[0] if len(x) == 1 else x
 
+### Field formats that consume the rest of the body
+_TAILS = {"string", "raw", "listof"}
+
+class _decoder:
+    """Compiled form of a packet format from packet._packetformats.
+
+    All fixed size fields at the head of the format are merged into a
+    single struct.Struct, so that a complete body is parsed with one
+    unpack_from call. The trailing "string", "raw" or "listof" field
+    (if any) is handled separately. Bodies shorter than the fixed head
+    (packets with optional fields at the end, like M_ICONIFY) are
+    parsed field by field, as before.
+    """
+
+    def __init__(self,fmt):
+        head = list()
+        self.tail = None
+        for field in fmt:
+            if field[1] in _TAILS:
+                self.tail = field
+                break
+            head.append(field)
+        self.names  = tuple( name for name, f in head )
+        self.struct = struct.Struct( "".join( f for name, f in head ) )
+        self.size   = self.struct.size
+        ### (name, format, offset, size) for the field by field parsing
+        self.fields = list()
+        offset = 0
+        for name, f in head:
+            self.fields.append( (name, f, offset, struct.calcsize(f)) )
+            offset += struct.calcsize(f)
+        ### Native alignment may insert padding between fields of
+        ### different sizes. FVWM does not, so then fall back to the
+        ### field by field parsing.
+        ### Formats with several values per field (like "3L") do not map
+        ### one to one on names, so they also go the slow way.
+        self.fast = ( offset == self.size and
+                      all( len(struct.unpack(f,bytes(s))) == 1
+                           for name, f, o, s in self.fields ) )
+        if self.tail and self.tail[1] == "listof":
+            self.item = struct.Struct(self.tail[2])
+            self.single = len(self.item.unpack(bytes(self.item.size))) == 1
+
+    def decode(self,body,ptype):
+        """Return a dictionary of fields parsed from the body of the
+        packet of type ptype.
+        """
+        length = len(body)
+        if self.fast and length >= self.size:
+            fields = dict( zip( self.names,
+                                self.struct.unpack_from(body,0) ) )
+            offset = self.size
+        else:
+            fields, offset = self._decode_fields(body,ptype)
+        ### There are variable length packs with optional fields at
+        ### the end, like M_ICONIFY, so the tail is only read if there
+        ### is something left in the body (or if there is nothing but tail).
+        if self.tail and ( offset < length or not self.fields ):
+            name = self.tail[0]
+            kind = self.tail[1]
+            if kind == "string":
+                ### body may be a memoryview, which has no .decode()
+                fields[name] = ( str( body[offset:],
+                                      FVWM_STR_CODEX, 'replace' ).
+                                 strip("\x00") )
+            elif kind == "raw":
+                fields[name] = body[offset:]
+            else:
+                if (length - offset) % self.item.size:
+                    raise PipeDesync(
+                        """While parsing packet {}:
+                        Format doesn't match the body of the packet 
+                        (while reading 'listof' format)
+                        """.format(packetnames[ptype]))
+                items = self.item.iter_unpack(body[offset:])
+                if self.single:
+                    fields[name] = [ x[0] for x in items ]
+                else:
+                    fields[name] = list(items)
+            offset = length
+        if offset != length:
+            ### Shall we raise en exception here???
+            packet.error( "While parsing packet {}: " +
+                          "Body of the packet is too long",
+                          packetnames[ptype] )
+        ### remove dummies
+        fields.pop("",None)
+        return fields
+
+    def _decode_fields(self,body,ptype):
+        fields = dict()
+        offset = 0
+        length = len(body)
+        for name, f, start, size in self.fields:
+            if start + size > length:
+                raise PipeDesync(
+                    "While parsing packet {}: ".
+                    format(packetnames[ptype]) +
+                    "Format doesn't match the body of the packet " +
+                    "(body of the packet is too short)" )
+            fields[name] = _unpack(f,body,start)
+            offset = start + size
+            if offset == length: break
+        return fields, offset
+
+def _readpacket(buf):
+    """Read the packet from buf. 
+    Return the triple (ptype, time, body) where body is the raw body of
+    the packet without the header.
+    """
+    try:
+        (start,ptype,size,time) = struct.unpack_from(
+            "4L", buf.read(LONG_SIZE*4), 0 )
+    except struct.error:
+        raise PipeDesync("Can not read the head of the packet")
+    if start != FVWM_PACK_START:
+        raise PipeDesync(
+            "Expected {}, got {} at the beginning of the packet".
+            format(hex(FVWM_PACK_START),hex(start)) )
+    ptype = _ptype_f2m(ptype)
+    packet.debug("Read {} at {}",packetnames[ptype],time)
+    body = buf.read(LONG_SIZE * (size-4))
+    return ptype, time, body
+
+class _framer:
+    """Instances of _framer split the stream of bytes coming from FVWM
+    into packets.
+
+    f = _framer(pipe)
+
+    f.read() reads whatever is available in the pipe into a reusable
+    buffer and returns the list of triples (ptype, time, body) for all 
+    complete packets in the buffer. It blocks until there is at least
+    one. Incomplete packets are kept in the buffer until the rest
+    arrives. If the header of the packet is broken, PipeDesync
+    exception is raised. The next call skips to the beginning of the
+    next packet, f.skipped counts the bytes thrown away and f.desyncs
+    the broken headers. f.received counts bytes read from the pipe.
+    If FVWM closed the pipe, EOFError is raised.
+
+    If the pipe is read by somebody else (e.g. by asyncio event loop),
+    pass the data to f.feed(data) and get the packets from f.split(),
+    which never blocks and returns an empty list if there are no
+    complete packets yet.
+
+    If zerocopy is True, every read from the pipe goes into a fresh
+    bytes object and bodies are read-only memoryview slices of it,
+    instead of copies from the reusable buffer. The chunk is freed, 
+    when all packets referring to it are gone.
+    """
+
+    _head = struct.Struct("4L")
+    ### Sanity limit for the size of the packet (in longs). FVWM never
+    ### sends packets nearly as big.
+    _maxsize = 1 << 16
+
+    def __init__(self,pipe,size=1<<16,zerocopy=False):
+        self._pipe  = pipe
+        self._size  = size
+        self.zerocopy = zerocopy
+        self._buf   = bytes() if zerocopy else bytearray(size)
+        self._view  = memoryview(self._buf)
+        ### unparsed data is in self._buf[self._start:self._end]
+        self._start = 0
+        self._end   = 0
+        ### True after a broken header until the next mark is found
+        self._desync = False
+        self.skipped = 0
+        self.desyncs = 0
+        self.received = 0
+
+    def read(self):
+        frames = self._split()
+        while not frames:
+            self._fill()
+            frames = self._split()
+        return frames
+
+    def feed(self,data):
+        """Append data, that was read from the pipe elsewhere, to the
+        buffer.
+        """
+        if not data:
+            return
+        self.received += len(data)
+        if self.zerocopy:
+            self._store(bytes(data))
+            return
+        n = len(data)
+        self._reserve(self._end - self._start + n)
+        self._buf[self._end:self._end+n] = data
+        self._end += n
+
+    def split(self):
+        """Return the list of triples (ptype, time, body) for all 
+        complete packets in the buffer.
+        """
+        return self._split()
+
+    def _split(self):
+        frames = list()
+        head   = self._head
+        hsize  = head.size
+        if self._desync and not self._seek():
+            return frames
+        buf    = self._buf
+        start  = self._start
+        end    = self._end
+        try:
+            while end - start >= hsize:
+                mark, ptype, size, time = head.unpack_from(buf,start)
+                ptype = _ptype_f2m(ptype)
+                if ( mark != FVWM_PACK_START or
+                     not 4 <= size <= self._maxsize or
+                     ptype not in packetnames ):
+                    if frames: break
+                    ### the packet at the current position is broken anyway
+                    start += 1
+                    self.skipped += 1
+                    self.desyncs += 1
+                    self._desync = True
+                    raise PipeDesync(
+                        "Broken header of the packet: start={}, "
+                        "type={}, size={}".
+                        format(hex(mark),hex(ptype),size) )
+                stop = start + LONG_SIZE * size
+                if stop > end: break
+                body = self._view[start+hsize:stop]
+                if not self.zerocopy:
+                    body = bytes(body)
+                frames.append( (ptype, time, body) )
+                start = stop
+        finally:
+            self._start = start
+        return frames
+
+    def _seek(self):
+        """Skip to the beginning of the next packet in the buffer.
+        Return False if there is none yet.
+        """
+        start, end = self._start, self._end
+        position = self._buf.find(FVWM_PACK_START_b,start,end)
+        if position == -1:
+            ### keep the tail, it might be the beginning of the mark
+            keep = min( end - start, len(FVWM_PACK_START_b) - 1 )
+            self.skipped += end - keep - start
+            self._start = end - keep
+            return False
+        self.skipped += position - start
+        self._start = position
+        self._desync = False
+        return True
+
+    def _fill(self):
+        """Read from the pipe whatever is available, but at least
+        something.
+        """
+        start, end = self._start, self._end
+        ### How much room do we need for the current packet?
+        need = self._head.size
+        if not self._desync and end - start >= need:
+            need = LONG_SIZE * self._head.unpack_from(self._buf,start)[2]
+        if self.zerocopy:
+            data = self._pipe.read1( max(need - (end - start), self._size) )
+            if not data:
+                raise EOFError("FVWM closed the pipe")
+            self.received += len(data)
+            self._store(data)
+            return
+        self._reserve(need)
+        n = self._pipe.readinto1(self._view[self._end:])
+        if not n:
+            raise EOFError("FVWM closed the pipe")
+        self.received += n
+        self._end += n
+
+    def _store(self,data):
+        """Make data the new buffer in zerocopy mode"""
+        ### only the incomplete packet is copied
+        if self._start < self._end:
+            data = self._buf[self._start:self._end] + data
+        self._buf   = data
+        self._view  = memoryview(data)
+        self._start = 0
+        self._end   = len(data)
+
+    def _reserve(self,need):
+        """Make sure the reusable buffer has room for need bytes
+        counting from the start of unparsed data.
+        """
+        start, end = self._start, self._end
+        if start == end:
+            self._start = self._end = start = end = 0
+        if start + need > len(self._buf):
+            ### move the incomplete packet to the beginning
+            self._buf[:end-start] = self._buf[start:end]
+            self._start, self._end = 0, end - start
+        if need > len(self._buf):
+            self._view.release()
+            self._buf.extend(bytes(need - len(self._buf)))
+            self._view = memoryview(self._buf)
+
 ################################################################################
 ### packet does the actual reading and parsing
 
@@ -175,74 +477,28 @@ class packet(dict):
         M_UNKNOWN1:       _empty
         }
 
+    ### compiled formats, see _decoder
+    _decoders = { ptype : _decoder(fmt)
+                  for ptype, fmt in _packetformats.items() }
+
     def __init__(self,buf):
-        try:
-            (start,ptype,size,time) = struct.unpack_from(
-                "4L", buf.read(LONG_SIZE*4), 0 )
-        except struct.error:
-            raise PipeDesync("Can not read the head of the packet")
-        if start != FVWM_PACK_START:
-            raise PipeDesync(
-                "Expected {}, got {} at the beginning of the packet".
-                format(hex(FVWM_PACK_START),hex(start)) )
-        
-        self.ptype = _ptype_f2m(ptype)
+        self._setup(*_readpacket(buf))
+
+    @classmethod
+    def _make(cls,ptype,time,body):
+        """Make the packet from its type, time stamp and raw body."""
+        self = dict.__new__(cls)
+        self._setup(ptype,time,body)
+        return self
+
+    def _setup(self,ptype,time,body):
+        self.ptype = ptype
         self.time  = time
-        self.debug("Read {} at {}",packetnames[self.ptype],self.time)
-        ### Read and parse the rest of the packet according to the format
-        ### corresponding to the type of the packet
-        body = buf.read(LONG_SIZE * (size-4))
         ### save the raw body of the packet
-        self.body = body
-        fmt = self._packetformats[self.ptype]
-        offset = 0
-        for field in fmt:
-            self.debug("field",field)
-            self.debug("offset",offset)
-            if field[1] == "string":
-                self[field[0]] = ( body[offset:].
-                                   decode(errors='replace').
-                                   strip("\x00") )
-                offset = len(body)
-                break
-            elif field[1] == "raw":
-                self[field[0]] = body[offset:]
-                offset = len(body)
-                break
-            elif field[1] == "listof":
-                self[field[0]] = list()
-                itemsize = struct.calcsize(field[2])
-                while offset + itemsize <= len(body):
-                    self[field[0]].append(_unpack(field[2],body,offset)) 
-                    offset += itemsize
-                if offset != len(body):
-                    raise PipeDesync(
-                        """While parsing packet {}:
-                        Format doesn't match the body of the packet 
-                        (while reading 'listof' format)
-                        """.format(packetnames[self.ptype]))
-            else:
-                try:
-                    self[field[0]] = _unpack(field[1], body, offset)
-                except struct.error:
-                    raise PipeDesync(
-                        "While parsing packet {}: ".
-                        format(packetnames[self.name]) +
-                        "Format doesn't match the body of the packet " +
-                        "(body of the packet is too short)" )
-
-                offset += struct.calcsize( field[1] )
-            ### There are variable length packs with optional fields at
-            ### the end, like M_ICONIFY, so we break if the body of the pack
-            ### is exhosted.
-            if offset == len(body): break
-        if offset != len(body):
-            ### Shall we raise en exception here???
-            self.error( "While parsing packet {}: " +
-                        "Body of the packet is too long",
-                        packetnames[self.ptype] )
-        ### remove dummies
-        if "" in self: del self[""]
+        self.body  = body
+        ### Parse the rest of the packet according to the format
+        ### corresponding to the type of the packet
+        self.update( self._decoders[ptype].decode(body,ptype) )
         
     @property
     def name(self):
@@ -250,6 +506,16 @@ class packet(dict):
         Return the string representation of the type of the packet
         """
         return packetnames[self.ptype]
+
+    def detach(self):
+        """Copy the body and raw fields of the packet, if they are 
+        memoryviews of the shared receive buffer (see _framer), so that
+        the buffer can be freed. Return the packet itself.
+        """
+        for k, v in self.items():
+            if isinstance(v,memoryview):
+                self[k] = bytes(v)
+        return self
     
     def __getattr__(self,attr):
         return self[attr]
@@ -270,7 +536,167 @@ class packet(dict):
             elif k=="time": continue
             elif k in {"window","frame"}:
                 res.append("\t| {} = {:x}".format(k,v))
+            elif isinstance(v,memoryview):
+                res.append("\t| {} = {}".format(k,bytes(v)))
             else:
                 res.append("\t| {} = {}".format(k,v))
         return "\n".join(res)
 
+
+################################################################################
+### compactpacket is the same as packet, but keeps the fields in slots
+
+class compactpacket:
+    """
+    Instances are packets received from fvwm, the same as instances of
+    packet, but fields are stored in __slots__ instead of a dictionary.
+    This makes them smaller and faster to access.
+
+    p = compactpacket(buf)
+
+    read the packet from buf. The returned object is an instance of a
+    subclass of compactpacket specific for the type of the packet 
+    (compactpacket.classes[p.ptype]). 
+    The fields can be accessed as p.key or p["key"]. p.keys(), p.items(), 
+    p.values(), p.get() and "key" in p work as for dictionaries, so
+    dict(p) gives the same dictionary as the corresponding instance of 
+    packet. Missing fields raise AttributeError when accessed as p.key
+    and KeyError when accessed as p["key"]. 
+    Fields not defined for the packet type can not be added.
+    """
+
+    __slots__ = ( "ptype", "time", "body" )
+    _keys     = __slots__
+    ### packet type -> subclass of compactpacket. Filled in below.
+    classes   = dict()
+    logger    = packet.logger
+
+    def __new__(cls,buf):
+        return cls._make(*_readpacket(buf))
+
+    @classmethod
+    def _make(cls,ptype,time,body):
+        """Make the packet from its type, time stamp and raw body."""
+        self = object.__new__(cls.classes[ptype])
+        self.ptype = ptype
+        self.time  = time
+        self.body  = body
+        for k, v in packet._decoders[ptype].decode(body,ptype).items():
+            setattr(self,k,v)
+        return self
+
+    name   = packet.name
+    detach = packet.detach
+
+    def __getitem__(self,key):
+        if key not in self._keys:
+            raise KeyError(key)
+        try:
+            return getattr(self,key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self,key,val):
+        if key not in self._keys:
+            raise KeyError(key)
+        setattr(self,key,val)
+
+    def __delitem__(self,key):
+        try:
+            delattr(self,key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self,key):
+        return key in self._keys and hasattr(self,key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self,key,default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [ k for k in self._keys if hasattr(self,k) ]
+
+    def values(self):
+        return [ getattr(self,k) for k in self.keys() ]
+
+    def items(self):
+        return [ (k, getattr(self,k)) for k in self.keys() ]
+
+    __str__ = packet.__str__
+
+def _compactclass(ptype,fmt):
+    fields = tuple( f[0] for f in fmt if f[0] )
+    return type( packetnames[ptype], (compactpacket,),
+                 { "__slots__" : fields,
+                   "_keys"     : compactpacket._keys + fields } )
+
+compactpacket.classes.update(
+    { ptype : _compactclass(ptype,fmt)
+      for ptype, fmt in packet._packetformats.items() } )
+
+################################################################################
+### lazypacket decodes the fields only when they are needed
+
+class lazypacket(compactpacket):
+    """
+    Instances are packets received from fvwm, the same as instances of
+    compactpacket, except that only the header of the packet (p.ptype,
+    p.time) is decoded when the packet is read. The rest of the fields
+    are decoded from p.body on the first access to any of them, 
+    e.g. p.key, p["key"], "key" in p or p.keys().
+
+    Since decoding is postponed, the PipeDesync exception for a
+    malformed body is raised when the fields are accessed, rather than 
+    in the reader thread.
+    """
+
+    __slots__ = ( "_decoded", )
+    classes   = dict()
+
+    @classmethod
+    def _make(cls,ptype,time,body):
+        """Make the packet from its type, time stamp and raw body."""
+        self = object.__new__(cls.classes[ptype])
+        self.ptype    = ptype
+        self.time     = time
+        self.body     = body
+        self._decoded = False
+        return self
+
+    def __getattr__(self,attr):
+        ### This is only called if attr is not set, i.e. either the
+        ### packet is not decoded yet or the field is missing.
+        if self._decoded or attr not in self._keys:
+            raise AttributeError(
+                "'{}' object has no attribute '{}'".
+                format(type(self).__name__, attr) )
+        self._decoded = True
+        for k, v in packet._decoders[self.ptype].decode(
+                self.body,self.ptype).items():
+            setattr(self,k,v)
+        return getattr(self,attr)
+
+    def detach(self):
+        if not self._decoded:
+            self.body = bytes(self.body)
+            return self
+        return super().detach()
+
+def _lazyclass(ptype,fmt):
+    fields = tuple( f[0] for f in fmt if f[0] )
+    return type( packetnames[ptype], (lazypacket,),
+                 { "__slots__" : fields,
+                   "_keys"     : compactpacket._keys + fields } )
+
+lazypacket.classes.update(
+    { ptype : _lazyclass(ptype,fmt)
+      for ptype, fmt in packet._packetformats.items() } )
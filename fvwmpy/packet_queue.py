@@ -1,16 +1,119 @@
+import heapq
 import struct
 import sys
 import threading
 import time
 
+from   collections import deque
+from   concurrent.futures import InvalidStateError
+
 from   .constants  import *
 from   .exceptions import *
 from   .log        import  _getloggers
-from   .packet     import packet
+from   .packet     import packet, _framer
 
 ################################################################################
 ### some helpers
 
+class _entry:
+    """Packet in the queue together with its sequence number. 
+    Removed packets are only marked as not alive and are dropped when 
+    they reach the head of the queue. 
+    """
+    __slots__ = ( "seq", "packet", "alive" )
+
+    def __init__(self,seq,p):
+        self.seq    = seq
+        self.packet = p
+        self.alive  = True
+
+def _seq(e):
+    return e.seq
+
+class _waiter:
+    """A thread waiting in _packet_queue.pick() for a packet, for which
+    picker evaluates to True. cond shares the lock of the queue.
+    """
+    __slots__ = ( "picker", "mask", "cond", "found" )
+
+    def __init__(self,picker,mask,lock):
+        self.picker = picker
+        self.mask   = mask
+        self.cond   = threading.Condition(lock)
+        self.found  = False
+
+class _metrics:
+    """Counters of the packet queue, see m.packets.metrics"""
+
+    def __init__(self,queue):
+        self._queue       = queue
+        ### packet type -> number of packets read from the pipe
+        self.packets      = dict()
+        ### packet type -> number of m.call_handlers() calls and
+        ### seconds spent in them
+        self.handled      = dict()
+        self.handler_time = dict()
+        ### the largest number of packets waiting in the queue
+        self.highwater    = 0
+        self.started      = time.monotonic()
+        ### log snapshot() every interval seconds, if not None
+        self.interval     = None
+        self._dumped      = self.started
+
+    def snapshot(self):
+        """Return a dictionary with the current values of counters.
+        Counters per packet type are keyed by packet names.
+        """
+        queue  = self._queue
+        framer = queue._framer
+        names  = lambda d: { packetnames.get(k,k) : v for k, v in d.items() }
+        ### the reader and call_handlers() change the counters
+        with queue._lock:
+            packets      = names(self.packets)
+            handled      = names(self.handled)
+            handler_time = names(self.handler_time)
+        return dict( uptime       = time.monotonic() - self.started,
+                     bytes        = framer.received,
+                     packets      = packets,
+                     total        = sum(packets.values()),
+                     queued       = len(queue),
+                     highwater    = self.highwater,
+                     coalesced    = queue.coalesced,
+                     desyncs      = framer.desyncs,
+                     skipped      = framer.skipped,
+                     handled      = handled,
+                     handler_time = handler_time )
+
+    def clear(self):
+        """Reset counters, except those of the framer"""
+        with self._queue._lock:
+            self.packets.clear()
+            self.handled.clear()
+            self.handler_time.clear()
+            self.highwater = self._queue._count
+        self.started   = self._dumped = time.monotonic()
+
+    ### called with the lock of the queue acquired
+    def _arrived(self,packs):
+        counts = self.packets
+        for p in packs:
+            counts[p.ptype] = counts.get(p.ptype,0) + 1
+
+    ### called by the reader without the lock
+    def _tick(self):
+        if self.interval is not None:
+            now = time.monotonic()
+            if now - self._dumped >= self.interval:
+                self._dumped = now
+                ### a lone dict argument is taken by logging as a mapping
+                self._queue.info("metrics: {}",str(self.snapshot()))
+
+    def _handled(self,ptype,seconds):
+        with self._queue._lock:
+            self.handled[ptype] = self.handled.get(ptype,0) + 1
+            self.handler_time[ptype] = ( self.handler_time.get(ptype,0) +
+                                         seconds )
+
 ################################################################################
 ###
 
@@ -26,14 +129,37 @@ class _packet_queue:
               module.alias+':packetreader')
         self.logger.setLevel(L_WARN)
         self._pipe            = module._fromfvwm
-        self._queue           = list()
-        self._nonempty        = threading.Event()
+        self._framer          = _framer(self._pipe,
+                                        zerocopy = module.zerocopy)
+        self.packet_class     = module.packet_class
+        ### tells the module, that we are about to wait for packets
+        self._idle            = module._idle
+        ### tells the module, which packets arrived, see m.syncstats
+        self._synced          = module._synced
+        ### _queue holds entries in order of arrival, _index holds
+        ### the same entries split by packet type.
+        self._queue           = deque()
+        self._index           = dict()
+        self._count           = 0
+        self._seq             = 0
         self._lock            = threading.Lock()
-        self._spack_found     = threading.Event()
-        self._spack_picker    = None
-        self._spack           = None
+        self._nonempty        = threading.Condition(self._lock)
+        ### threads waiting for special packets, see _waiter
+        self._waiters         = list()
         self._thread_exception = None
         self._packet_picker   = None
+        ### futures for replies to m.sendreplies() by unique id
+        self._replies         = dict()
+        ### types of packets coalesced per window, see m.coalesce
+        self.coalesce         = module.coalesce
+        ### (ptype, window) -> the queued entry to be replaced
+        self._latest          = dict()
+        ### number of packets dropped in favour of newer ones
+        self.coalesced        = 0
+        self.metrics          = _metrics(self)
+        self._start()
+
+    def _start(self):
         self._reader_thread   = threading.Thread( target = self._reader,
                                                   name   = "reader_thread",
                                                   daemon = True            )
@@ -41,49 +167,73 @@ class _packet_queue:
         self._reader_thread.start()
 
     def __bool__(self):
-        return bool(self._queue)
+        return bool(self._count)
 
     def __len__(self):
-        return len(self._queue)
+        return self._count
+
+    @property
+    def zerocopy(self):
+        """True if packet bodies are memoryviews of the receive buffer"""
+        return self._framer.zerocopy
 
     ### This is the one to be threaded (daemon)
     def _reader(self):
         while True:
+            held    = False
+            replies = ()
+            failed  = None
             try:
-                p = packet(self._pipe)
-                self.debug("threaded_reader: got {} at {}",p.name,p.time)
-                ### for testing DON'T FORGET to remove!!!
-                if p.ptype == M_STRING and p.string == "exception":
-                    raise Exception
+                ### All complete packets available in the pipe
+                packs = self._make(self._framer.read())
+                self.debug("threaded_reader: got {} packets",len(packs))
+                if not packs: continue
                 
                 self._lock.acquire()
-                self._queue.append(p)
-                ### Are we waiting for some special packet?
-                if self._spack_picker and self._spack_picker(p):
-                    ### Were waiting and packet arrived
-                    self.debug("threaded_reader: found special pack {}",p.name)
-                    self._spack = (len(self._queue)-1, p)
-                    self._spack_picker = None
-                    self._spack_found.set()
-                self._nonempty.set()
+                held = True
+                self.metrics._arrived(packs)
+                packs, replies = self._demux(packs)
+                self._synced(packs)
+                for p in packs:
+                    self._append(p)
+                ### Is anybody waiting for some special packet?
+                for w in self._waiters:
+                    if not w.found and self._matches(w,packs):
+                        w.found = True
+                        w.cond.notify()
+                self._nonempty.notify_all()
             except PipeDesync as e:
+                ### The framer will skip to the next packet
                 self.error( "threaded_reader: {}",repr(e))
                 self.error( "threaded_reader: Resync the pipe. "+
                             "Packet(s) may be lost.")
-                self._resync()
             except BaseException as e:
                 ### We want to pass any exception to the main thread
                 ### but then there could be a delay in handling.
                 ### What is a better solution?
                 self.error("threaded_reader: {}",repr(e))
                 self.error("threaded_reader: pass to the main thread")
-                self._thread_exception = e
-                ### set events so there is no waiting in the main thread
-                ### main must now check and clear events
-                self._spack_found.set()
-                self._nonempty.set()
+                if not held:
+                    self._lock.acquire()
+                    held = True
+                self._thread_exception = failed = e
+                ### wake everybody up, so there is no waiting
+                for w in self._waiters:
+                    w.cond.notify()
+                self._nonempty.notify_all()
+                replies = self._replies
+                self._replies = dict()
             finally:
-                if self._lock.locked(): self._lock.release()
+                if held: self._lock.release()
+            ### Futures run their callbacks right away, so this is done
+            ### without the lock
+            if failed is None:
+                self._resolve(replies)
+                self.metrics._tick()
+            else:
+                self._fail(replies.values(),failed)
+                ### Nothing more will come from the closed pipe
+                if isinstance(failed,EOFError): return
             ### Slow it down for debugging. DON'T FORGET!!!
             # time.sleep(0.01)
 
@@ -96,27 +246,28 @@ class _packet_queue:
         If keep is False, remove the packet from the queue, otherwise keep 
         it there.
         """
-        ### Let's see if something bad happened in the thread.
-        self._check_exception()
-        self.debug( "read: queue size={}; queue_nonempty={}",
-                    len(self._queue),
-                    bool(self) )
-        gotpack = self._nonempty.wait(timeout)
-        ### Let's see if the thread got an exception while we were waiting
-        self._check_exception()
-        if gotpack:
-            p = self._queue[0]
-            self.debug( "read: got {} at {} from {} packets",
-                          p.name,p.time,len(self))
-            if not keep:
-                self._lock.acquire()
-                del self._queue[0]
-                if not self._queue: self._nonempty.clear()
-                self._lock.release()
-            return p
-        else: 
-            self.debug("read: queue is empty, returning None after timeout")
-            return None
+        if not self._count:
+            self._idle()
+        with self._lock:
+            ### Let's see if something bad happened in the thread.
+            self._check_exception()
+            self.debug( "read: queue size={}; queue_nonempty={}",
+                        len(self), bool(self) )
+            gotpack = self._nonempty.wait_for(
+                lambda: self._count or self._thread_exception, timeout )
+            ### Let's see if the thread got an exception while we were waiting
+            self._check_exception()
+            if gotpack:
+                e = self._head()
+                p = e.packet
+                self.debug( "read: got {} at {} from {} packets",
+                            p.name,p.time,len(self))
+                if not keep:
+                    self._remove(e)
+                return p
+            else: 
+                self.debug("read: queue is empty, returning None after timeout")
+                return None
 
     def pick(self,picker,until=None,timeout=0.5,keep=False):
         """Find and return all packets in the queue for which picker 
@@ -127,71 +278,210 @@ class _packet_queue:
         Keep packets in the queue if keep is True, otherwise remove them.
         That does not includes the packet that marks the end of the search,
         unless it is also picked.
+
+        If picker (or until) has attribute mask (see fvwmpy.picker), only
+        packets of the types matching the mask are looked at.
+
+        Several threads may wait in pick() at the same time, each of them
+        is woken up when its own until packet arrives.
         """
-        self._check_exception()
         if until is None:
             until = picker
-        packs = list()
-        indices = list()
-        try:
-            self._lock.acquire()
-            if not any( map(until,self._queue) ):
+        pmask = getattr(picker,"mask",None)
+        umask = getattr(until,"mask",None)
+        self._idle()
+        with self._lock:
+            self._check_exception()
+            stop = self._find(until,umask)
+            if stop is None:
                 self.debug("pick: Didn'r reach until. Wait for the threaded reader")
-                self._spack_picker = until
-                self._spack_found.clear()
-                self._lock.release()
-                self._spack_found.wait(timeout)
+                w = _waiter(until,umask,self._lock)
+                self._waiters.append(w)
+                try:
+                    w.cond.wait_for(
+                        lambda: w.found or self._thread_exception, timeout )
+                finally:
+                    self._waiters.remove(w)
                 self._check_exception()
-                self._lock.acquire()
-            for i, p in enumerate(self._queue):
-                if picker(p):
-                    self.debug("pick: {}. picked a pack {}",i,p.name)
-                    indices.append(i)
-                    packs.append(p)
-                if until(p):
-                    self.debug("pick: reached until")
+                stop = self._find(until,umask)
+            if stop is not None:
+                self.debug("pick: reached until")
+            found = list()
+            for e in self._entries(pmask):
+                if stop is not None and e.seq > stop:
                     break
+                if picker(e.packet):
+                    self.debug("pick: {}. picked a pack {}",
+                               e.seq,e.packet.name)
+                    found.append(e)
             self.debug("pick: found {} out of {} packs",
-                       len(indices),len(self)    )
+                       len(found),len(self)    )
             if not keep:
                 self.debug("pick: deleting found")
-                for i in reversed(indices):
-                    del self._queue[i]
-            if not self._queue: self._nonempty.clear()
-            return packs
-        finally:
-            self._spack_picker = None
-            if self._lock.locked(): self._lock.release()
+                for e in found:
+                    self._remove(e)
+            return [ e.packet for e in found ]
             
     def clear(self):
         "Clear the queue."
         self._lock.acquire()
         self._queue.clear()
+        self._index.clear()
+        self._latest.clear()
+        self._count = 0
         self._lock.release()
 
+    def _make(self,frames):
+        """Make packets out of (ptype, time, body) triples"""
+        make  = self.packet_class._make
+        packs = list()
+        for ptype, time, body in frames:
+            try:
+                packs.append( make(ptype,time,body) )
+            except PipeDesync as e:
+                self.error( "reader: {}",repr(e))
+                self.error( "reader: {} dropped",packetnames[ptype] )
+        return packs
+
+    def _matches(self,w,packs):
+        """Is any of packs the one, that waiter w is waiting for?"""
+        for p in packs:
+            if ( w.mask is None or p.ptype & w.mask ) and w.picker(p):
+                self.debug("reader: found special pack {}",p.name)
+                return True
+        return False
+
+    @staticmethod
+    def _resolve(replies):
+        for f, reply in replies:
+            try:
+                f.set_result(reply)
+            except InvalidStateError:
+                ### cancelled meanwhile
+                pass
+
+    @staticmethod
+    def _fail(futures,e):
+        for f in futures:
+            try:
+                f.set_exception(e)
+            except InvalidStateError:
+                pass
+
+    def _expect(self,uid,future):
+        """Resolve future with the MX_REPLY packet, that starts with
+        uid+':', instead of queueing the packet.
+        """
+        with self._lock:
+            self._check_exception()
+            self._replies[uid] = future
+
+    def _forget(self,uid):
+        with self._lock:
+            self._replies.pop(uid,None)
+
+    ### The following must be called with self._lock acquired
+    def _demux(self,packs):
+        """Take replies expected by m.sendreplies() out of packs.
+        Return the rest of the packs and the list of (future, reply)
+        pairs.
+        """
+        if not self._replies:
+            return packs, ()
+        rest    = list()
+        replies = list()
+        for p in packs:
+            if p.ptype == MX_REPLY:
+                uid, sep, reply = p.string.partition(":")
+                f = self._replies.pop(uid,None) if sep else None
+                if f is not None:
+                    replies.append( (f, reply) )
+                    continue
+            rest.append(p)
+        return rest, replies
+
+    def _append(self,p):
+        e = _entry(self._seq,p)
+        self._seq += 1
+        if p.ptype & self.coalesce:
+            ### The newer packet goes to the end of the queue, the
+            ### older one of the same window is dropped
+            key = (p.ptype, p.get("window"))
+            old = self._latest.get(key)
+            if old is not None and old.alive:
+                self._remove(old)
+                self.coalesced += 1
+            self._latest[key] = e
+        self._queue.append(e)
+        try:
+            self._index[p.ptype].append(e)
+        except KeyError:
+            self._index[p.ptype] = deque((e,))
+        self._count += 1
+        if self._count > self.metrics.highwater:
+            self.metrics.highwater = self._count
+
+    def _head(self):
+        """Return the oldest entry in the queue or None"""
+        queue = self._queue
+        while queue and not queue[0].alive:
+            queue.popleft()
+        return queue[0] if queue else None
+
+    def _remove(self,e):
+        e.alive = False
+        self._count -= 1
+        p = e.packet
+        if p.ptype & self.coalesce:
+            key = (p.ptype, p.get("window"))
+            if self._latest.get(key) is e:
+                del self._latest[key]
+        queue = self._queue
+        if queue and queue[0] is e:
+            queue.popleft()
+        index = self._index[e.packet.ptype]
+        while index and not index[0].alive:
+            index.popleft()
+        ### Too many removed entries in the middle. Get rid of them.
+        if len(queue) > 2 * self._count + 1024:
+            self._compact()
+
+    def _compact(self):
+        self._queue = deque( e for e in self._queue if e.alive )
+        for ptype, index in self._index.items():
+            self._index[ptype] = deque( e for e in index if e.alive )
+
+    def _entries(self,mask=None):
+        """Iterate over live entries in the order of arrival. If mask is
+        not None, only over entries of matching types.
+        """
+        if mask is None:
+            entries = self._queue
+        else:
+            indices = [ index for ptype, index in self._index.items()
+                        if ptype & mask and index ]
+            if not indices:
+                return
+            elif len(indices) == 1:
+                entries = indices[0]
+            else:
+                entries = heapq.merge(*indices,key=_seq)
+        for e in entries:
+            if e.alive:
+                yield e
+
+    def _find(self,until,mask=None):
+        """Return the sequence number of the first entry for which until
+        evaluates to True or None.
+        """
+        for e in self._entries(mask):
+            if until(e.packet):
+                return e.seq
+        return None
+
     def _check_exception(self):
         if self._thread_exception:
             e = self._thread_exception
             self._thread_exception = None
             self.debug("check_exception: {} detected in the thread",repr(e))
-            ### thread sets events for the main thread to proceed
-            ### we have to clear, if necessary
-            self._spack_found.clear()
-            if not self._queue:
-                self._nonempty.clear()
             raise e
-
-    def _resync(self):
-        """Seek the pipe to the start of the next packet"""
-        found = False
-        while not found:
-            peek     = self._pipe.peek()
-            position = peek.find(FVWM_PACK_START_b)
-            if position == -1:
-                self._pipe.read(len(peek))
-                ### let's wait a bit
-                time.sleep(0.05)
-            else:
-                self._pipe.read(position)
-                found = True
-
@@ -1,4 +1,6 @@
 import fnmatch
+import functools
+import re
 
 ################################################################################
 ### some helpers
@@ -10,9 +12,17 @@ import fnmatch
 ################################################################################
 
 class picker:
+    """Picker objects are kept as expressions (see _node) and are
+    compiled into a single function on the first call. Pickers with
+    the same structure share the code, only the values differ.
+    """
+    ### mask is the mask matching all packet types for which the picker 
+    ### can possibly be true, or None if it is not known.
+    ### The packet queue uses it to skip other packets.
     def __init__(self, fcn=None, mask=None, **kwargs):
         if fcn is None:
-            self.fcn = self._picker_factory(mask,**kwargs)
+            self._node = ("leaf", mask, kwargs)
+            self.mask = mask
             _str = list()
             if mask:
                 _str.append("mask=0x{:x}".format(mask))
@@ -20,12 +30,28 @@ class picker:
                 _str.append("{}={}".format(k,v))
             self._str="picker(" + ",".join(_str) + ")"
         elif mask is None and not kwargs:
-            self.fcn = fcn
+            self._node = ("fcn", None, fcn)
+            self.mask = None
             self._str= "picker({})".format(fcn)
         else:
             raise ValueError( "Wrong arguments signature. "+
                               "Must be either picker(fcn=fcn) or " +
                               "picker(mask=mask,**kwargs)" )
+
+    @classmethod
+    def _combine(cls,node,mask,_str):
+        pick = cls.__new__(cls)
+        pick._node = node
+        pick.mask  = mask
+        pick._str  = _str
+        return pick
+
+    def __getattr__(self,name):
+        ### compile on the first call
+        if name != "fcn":
+            raise AttributeError(name)
+        self.fcn = _compile(self._node)
+        return self.fcn
         
     def __str__(self):
         return self._str
@@ -36,45 +62,116 @@ class picker:
         return self.fcn(p)
     
     def __and__(self,other):
-        def fcn(p):
-            return self.fcn(p) and other.fcn(p)
-        pick = picker(fcn=fcn)
-        pick._str = "(" + self._str + " & " + other._str + ")"
-        return pick
+        if self.mask is None:
+            mask = other.mask
+        elif other.mask is None:
+            mask = self.mask
+        else:
+            mask = self.mask & other.mask
+        return self._combine( ("and", mask, self._node, other._node), mask,
+                              "(" + self._str + " & " + other._str + ")" )
 
     __rand__ = __and__
     
     def __or__(self,other):
-        def fcn(p):
-            return self.fcn(p) or other.fcn(p)
-        pick = picker(fcn=fcn)
-        pick._str = "(" + self._str + " | " + other._str + ")"
-        return pick
+        mask = None
+        if not ( self.mask is None or other.mask is None ):
+            mask = self.mask | other.mask
+        return self._combine( ("or", mask, self._node, other._node), mask,
+                              "(" + self._str + " | " + other._str + ")" )
 
     __ror__ = __or__
     
     def __invert__(self):
-        def fcn(p):
-            return not self.fcn(p)
-        pick = picker(fcn=fcn)
-        pick._str = "~" + self._str
-        return pick
+        return self._combine( ("not", None, self._node), None,
+                              "~" + self._str )
 
+################################################################################
+### compiling pickers
 
-    @classmethod
-    def _picker_factory(cls, mask=None,**kwargs):
-        def fcn(p):
-            debug("picker_fcn: working")
-            if ( (mask is not None) and
-                 (not p["ptype"] & mask) ):
-                # debug("Check {}=p['ptype'] ?= {}",
-                      # bin(p.get("ptype")),bin(mask))
-                return False
-            for k,v in kwargs.items():
-                # debug("Check {}=p[{}] ?= {}",p.get(k),k,v)
-                if not ( k in p and p[k] == v ): return False
-            return True
-        return fcn
+def _source(node,known,consts):
+    """Return python expression evaluating node on the packet p.
+    known is the mask of packet types p can be of (or None). Values
+    are appended to consts and referred to as c[i].
+    """
+    kind, mask = node[0], node[1]
+    if kind == "leaf":
+        terms = list()
+        ### the mask is only checked, if it excludes some known types
+        if mask is not None and ( known is None or known & ~mask ):
+            terms.append("p['ptype'] & {}".format(mask))
+        for k, v in node[2].items():
+            i = len(consts)
+            if isinstance(v,(glob,Glob)):
+                consts.append(v._matcher)
+                terms.append("({0!r} in p and c[{1}](p[{0!r}]))".format(k,i))
+            else:
+                consts.append(v)
+                terms.append("({0!r} in p and p[{0!r}] == c[{1}])".format(k,i))
+        return "(" + " and ".join(terms) + ")" if terms else "True"
+    elif kind == "fcn":
+        if node[2] is None:
+            return "True"
+        consts.append(node[2])
+        return "c[{}](p)".format(len(consts)-1)
+    elif kind == "and":
+        a, b = node[2], node[3]
+        first = _source(a,known,consts)
+        ### b is only evaluated if a is true
+        if a[1] is not None:
+            known = a[1] if known is None else known & a[1]
+        return "(" + first + " and " + _source(b,known,consts) + ")"
+    elif kind == "or":
+        return ( "(" + _source(node[2],known,consts) + " or " +
+                 _source(node[3],known,consts) + ")" )
+    else:
+        return "(not " + _source(node[2],known,consts) + ")"
+
+@functools.lru_cache(maxsize=256)
+def _code(source):
+    return compile("lambda p: True if " + source + " else False",
+                   "<picker>", "eval")
+
+def _compile(node):
+    consts = list()
+    mask   = node[1]
+    if node[0] == "leaf" or mask is None:
+        source = _source(node,None,consts)
+    else:
+        ### check the overall mask first, then the rest knowing it
+        source = "(p['ptype'] & {} and {})".format(
+            mask, _source(node,mask,consts) )
+    return eval(_code(source), { "c" : tuple(consts) })
+
+### characters special in glob patterns
+_special = re.compile(r"[*?[]")
+
+@functools.lru_cache(maxsize=1024)
+def _glob_matcher(pattern,fold):
+    """Return a function of a string telling if it matches the glob
+    pattern. If fold is True, pattern must be lower case and the
+    string is lower cased before matching. Patterns without special
+    characters other than leading or trailing '*' are matched with
+    string methods instead of regular expressions.
+    """
+    core = pattern.strip("*")
+    if _special.search(core) or not core:
+        match = re.compile(fnmatch.translate(pattern)).match
+        test  = lambda s: match(s) is not None
+    else:
+        head = pattern.startswith("*")
+        tail = pattern.endswith("*")
+        if head and tail:
+            test = lambda s: core in s
+        elif tail:
+            test = lambda s: s.startswith(core)
+        elif head:
+            test = lambda s: s.endswith(core)
+        else:
+            test = lambda s: s == core
+    if fold:
+        return lambda s: test(s.lower())
+    return lambda s: test(str.__str__(s))
 
 class glob(str):
     """Instance of glob is a string considered as a glob pattern.
@@ -101,8 +198,18 @@ class glob(str):
     # def __hash__(self):
         # return super().__hash__()
     
+    def __new__(cls,pattern):
+        self = super().__new__(cls,pattern)
+        ### compiled once, see _glob_matcher()
+        self._matcher = _glob_matcher(self.lower(),True)
+        return self
+
+    def __reduce__(self):
+        ### the matcher can not be pickled, it is looked up again
+        return ( type(self), (str.__str__(self),) )
+
     def __eq__(self,other):
-        return fnmatch.fnmatchcase(other.lower(),self.lower())
+        return self._matcher(other)
     
     def __ne__(self,other):
         return not self.__eq__(other)
@@ -128,8 +235,18 @@ class Glob(str):
     
     __repr__ = __str__
 
+    def __new__(cls,pattern):
+        self = super().__new__(cls,pattern)
+        ### compiled once, see _glob_matcher()
+        self._matcher = _glob_matcher(str.__str__(self),False)
+        return self
+
+    def __reduce__(self):
+        ### the matcher can not be pickled, it is looked up again
+        return ( type(self), (str.__str__(self),) )
+
     def __eq__(self,other):
-        return fnmatch.fnmatchcase(str.__str__(other),str.__str__(self))
+        return self._matcher(other)
     
     def __ne__(self,other):
         return not self.__eq__(other)
@@ -0,0 +1,301 @@
+"""Snapshot of the winlist and config databases on disk.
+
+A module saves what it knows with m.savesnapshot(). The next module
+started by the same FVWM loads it with m.loadsnapshot() instead of
+asking FVWM for the whole window list and configuration, and only
+checks with FVWM, that the windows are still the same.
+
+The snapshot is a marshal dump of plain python values. It is read
+through mmap. The file is private to the user and is keyed by the
+display and the process id of FVWM (the parent of the module). Since
+the default directory may be shared, load() does not follow symbolic
+links and ignores files, that belong to somebody else or are
+accessible by group or others.
+
+The winlist is shared by all modules. Module configuration lines are
+restored only by the module, that saved them.
+"""
+import itertools
+import marshal
+import mmap
+import os
+import stat
+import tempfile
+
+from   .flags    import windowflags
+from   .colorset import colorset
+
+### bumped whenever the layout of the snapshot changes
+_version = 3
+
+### config attributes saved as they are
+_config_attrs = ( "DesktopSize", "ImagePath", "XineramaConfig",
+                  "ClickTime", "IgnoreModifiers", "DesktopNames" )
+
+### winlist attributes saved as they are
+_winlist_attrs = ( "desk", "viewport", "screen", "pages" )
+
+def snapshot_key():
+    """(display, FVWM pid) the snapshot belongs to"""
+    return ( os.environ.get("DISPLAY",""), os.getppid() )
+
+def snapshot_path(key=None):
+    """Default path of the snapshot file for key"""
+    display, pid = key or snapshot_key()
+    directory = os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    name = "fvwmpy-{}-{}-{}.snapshot".format( os.getuid(),
+                                              display.replace("/","_"), pid )
+    return os.path.join(directory,name)
+
+def _plain(v):
+    """Value marshal can dump"""
+    if isinstance(v,memoryview):
+        return bytes(v)
+    if isinstance(v,int) and type(v) not in (int, bool):
+        return int(v)
+    return v
+
+def dump(winlist,config,alias,key=None):
+    """Return the snapshot of winlist and config of the module alias
+    as bytes
+    """
+    windows = { wid : { k : _plain(v) for k, v in w.items() }
+                for wid, w in winlist.items() }
+    data = dict(
+        version   = _version,
+        key       = key or snapshot_key(),
+        alias     = alias,
+        windows   = windows,
+        winlist   = { a : getattr(winlist,a) for a in _winlist_attrs },
+        complete  = winlist.complete,
+        config    = { a : getattr(config,a) for a in _config_attrs },
+        colorsets = [ None if cs is None else (cs.number,) + tuple(cs)
+                      for cs in config.colorsets ],
+        lines     = list(config) )
+    return marshal.dumps(data)
+
+def save(winlist,config,alias,path=None,key=None):
+    """Write the snapshot atomically"""
+    key  = key or snapshot_key()
+    path = path or snapshot_path(key)
+    data = dump(winlist,config,alias,key)
+    ### mkstemp creates the file readable by the user only
+    fd, tmp = tempfile.mkstemp( dir    = os.path.dirname(path),
+                                prefix = ".fvwmpy-" )
+    try:
+        with os.fdopen(fd,"wb") as f:
+            f.write(data)
+        os.replace(tmp,path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def load(path=None,key=None):
+    """Return the snapshot as a dictionary or None if there is no
+    usable snapshot.
+    """
+    key  = key or snapshot_key()
+    path = path or snapshot_path(key)
+    try:
+        fd = os.open(path,os.O_RDONLY|getattr(os,"O_NOFOLLOW",0))
+    except OSError:
+        return None
+    try:
+        st = os.fstat(fd)
+        if ( not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid() or
+             st.st_mode & ( stat.S_IRWXG | stat.S_IRWXO ) ):
+            return None
+        with mmap.mmap(fd,0,access=mmap.ACCESS_READ) as mm:
+            data = marshal.loads(mm)
+    except (OSError, ValueError, EOFError, TypeError):
+        return None
+    finally:
+        os.close(fd)
+    if ( not isinstance(data,dict) or data.get("version") != _version or
+         tuple(data.get("key",())) != tuple(key) ):
+        return None
+    return data
+
+def restore_winlist(winlist,data,window_class):
+    """Fill winlist from the snapshot data"""
+    winlist.clear()
+    for a, v in data["winlist"].items():
+        setattr(winlist,a,v)
+    for wid, d in data["windows"].items():
+        w = window_class(d)
+        if "winflags" in w:
+            w["winflags"] = windowflags(w["winflags"])
+        winlist[wid] = w
+        if winlist.geometry is not None and "wx" in w:
+            winlist.geometry.update( wid, w["wx"], w["wy"], w["wdx"],
+                                     w["wdy"], w["desk"], w["layer"] )
+    winlist.complete = data["complete"]
+
+def restore_config(config,data,alias):
+    """Apply the snapshot data to config. Subscribers of config are told
+    about changes as usual. Module lines are restored only if the
+    snapshot was saved by the module alias. Return False if they are
+    not.
+    """
+    for a, v in data["config"].items():
+        if a == "DesktopNames":
+            for desk, name in v.items():
+                config.set(a,name,desk)
+        else:
+            config.set(a,v)
+    for cs in data["colorsets"]:
+        if cs is not None:
+            config.set( "colorsets",
+                        colorset([ "{:x}".format(n) for n in cs ]), cs[0] )
+    if data["alias"].lower() != alias.lower():
+        return False
+    match = "*" + alias.lower()
+    config.begin(match)
+    for line in data["lines"]:
+        if line.lower().startswith(match):
+            config.ingest(line)
+    config.end()
+    return True
+
+### window attributes -> FVWM variables telling them
+_names = ( ("win_name",  "w.name"),
+           ("ico_name",  "w.iconname"),
+           ("res_class", "w.class"),
+           ("res_name",  "w.resource") )
+
+### window attributes and flags of fvwmpy.windowflags -> FVWM
+### conditions telling them
+_states = ( ("iconified", "Iconic"),
+            ("shaded",    "Shaded") )
+_flags  = ( ("sticky_across_pages", "StickyAcrossPages"),
+            ("sticky_across_desks", "StickyAcrossDesks") )
+
+_hit = "CirculateHit, CirculateHitIcon, CirculateHitShaded"
+
+### separates names, which may contain spaces, in the reply
+_sep = "\x1f"
+
+def delta_flags():
+    """Return the flags of windowflags.bits, FVWM is asked about, or
+    None if some of the flags can not be checked with FVWM.
+    """
+    names   = tuple( name for name, cond in _flags
+                     if name in windowflags.bits )
+    checked = windowflags.mask(*names)
+    for name in windowflags.bits:
+        if windowflags.mask(name) & ~checked:
+            return None
+    return names
+
+def delta_query(alias,flags,colorsets=None):
+    """Commands asking FVWM to send to the module alias what
+    fingerprint() tells about every window (nothing if flags is None)
+    and what config_fingerprint() tells about colorsets (nothing if
+    colorsets is None). The last reply is
+    'snapshotdone desk vx vy [pagesx pagesy fg bg fg bg ...]'.
+
+    FVWM has no variables for the state of a window, so there is a
+    command for every combination of states and flags, each matching
+    windows with just these. FVWM replies with one line per window.
+    """
+    send   = "SendToModule {} ".format(alias)
+    query  = list()
+    if flags is not None:
+        states = _states + tuple( (name, cond) for name, cond in _flags
+                                  if name in flags )
+        reply  = ( "snapshot {} $[w.id] $[w.x] $[w.y] $[w.width] "
+                   "$[w.height] $[w.desk] $[w.layer]" +
+                   "".join( _sep + "$[{}]".format(var)
+                            for attr, var in _names ) )
+        for values in itertools.product((False,True),repeat=len(states)):
+            conds = [ ("" if v else "!") + cond
+                      for v, (attr, cond) in zip(values,states) ]
+            tag   = ",".join( attr for v, (attr, cond)
+                              in zip(values,states) if v ) or "-"
+            query.append( "All ({}) {}{}".format( ", ".join([_hit]+conds),
+                                                  send, reply.format(tag) ) )
+    done = send + "snapshotdone $[desk.n] $[vp.x] $[vp.y]"
+    if colorsets is not None:
+        done += " $[desk.pagesx] $[desk.pagesy]"
+        for n in colorsets:
+            done += " $[fg.cs{0}] $[bg.cs{0}]".format(n)
+    query.append(done)
+    return query
+
+def parse_delta(strings,colorsets=None):
+    """Parse the replies to delta_query(). Return (desk, viewport,
+    { window id : window like dictionary }, config fingerprint or None).
+    Raise ValueError or IndexError if they make no sense.
+    """
+    windows = dict()
+    done    = None
+    for s in strings:
+        if s.startswith("snapshotdone "):
+            done = s.split()[1:]
+            continue
+        head, *names = s.split(_sep)
+        tag, attrs, wid, *vals = head.split()
+        if tag != "snapshot":
+            continue
+        w = dict( zip( ("wx","wy","wdx","wdy","desk","layer"),
+                       map(int,vals) ) )
+        ### the reply is stripped, so empty names at the end are gone
+        names += [""] * ( len(_names) - len(names) )
+        for (attr, var), name in zip(_names,names):
+            w[attr] = name
+        attrs = attrs.split(",") if attrs != "-" else ()
+        w["iconified"] = "iconified" in attrs
+        w["shaded"]    = "shaded" in attrs
+        w["winflags"]  = windowflags( windowflags.mask(
+            *( a for a in attrs if a not in ("iconified", "shaded") ) ) )
+        windows[int(wid,0)] = w
+    if done is None:
+        raise ValueError("no snapshotdone in the reply")
+    desk, vx, vy = map(int,done[:3])
+    config = None
+    if colorsets is not None:
+        colors = [ _rgb(c) for c in done[5:] ]
+        config = ( (int(done[3]), int(done[4])),
+                   tuple( (n, colors[2*i], colors[2*i+1])
+                          for i, n in enumerate(colorsets) ) )
+    return desk, (vx, vy), windows, config
+
+def _rgb(color):
+    """(red, green, blue) of an 'rgb:rrrr/gggg/bbbb' color name scaled
+    to 8 bits, or the name itself if it is in some other form
+    """
+    if not color.startswith("rgb:"):
+        return color
+    try:
+        return tuple( int(c,16) * 255 // ( 16 ** len(c) - 1 )
+                      for c in color[4:].split("/") )
+    except (ValueError, ZeroDivisionError):
+        return color
+
+def config_fingerprint(config,colorsets):
+    """What FVWM tells about config in reply to delta_query() with
+    colorsets: DesktopSize and foreground and background of the
+    colorsets. ImagePath and the rest can not be checked.
+    """
+    def rgb(cs,name):
+        try:
+            return cs.rgb(name)
+        except AttributeError:
+            return None
+    res = list()
+    for n in colorsets:
+        cs = config.colorsets[n] if n < len(config.colorsets) else None
+        res.append( (n, rgb(cs,"fg"), rgb(cs,"bg")) )
+    return ( tuple(config.DesktopSize), tuple(res) )
+
+def fingerprint(w,flags):
+    """What FVWM tells about window w in reply to delta_query() with
+    flags, see fvwmpy.loadsnapshot()
+    """
+    winflags = w.get("winflags")
+    return ( w.get("wx"), w.get("wy"), w.get("wdx"), w.get("wdy"),
+             w.get("desk"), w.get("layer"),
+             tuple( (w.get(attr) or "").strip() for attr, var in _names ),
+             bool(w.get("iconified")), bool(w.get("shaded")),
+             None if winflags is None else
+             tuple( getattr(winflags,name) for name in flags ) )
@@ -0,0 +1,142 @@
+import threading
+import time
+
+from   collections import deque
+
+from   .constants import packetnames
+
+class syncstats:
+    """Latency of packets in syncmask.
+
+    While FVWM waits for NOP UNLOCK after sending a packet in syncmask,
+    it is frozen. s = m.syncstats measures, per packet type, the time
+    from the arrival of such packet from the pipe until m.unlock()
+    writes NOP UNLOCK to FVWM.
+
+    s.percentiles(ptype=None,q=(50,90,99)) returns { q : seconds }
+    s.samples[ptype] are the last s.size latencies of ptype packets
+    s.pending is the number of packets waiting for m.unlock()
+    s.autounlocks is the number of packets unlocked by the watchdog
+
+    If deadline is not None, a watchdog thread calls onexpire(ptype,
+    waited) when a packet waits for longer than deadline seconds and
+    then counts it as unlocked. The next m.unlock() without a packet
+    to unlock is then not sent to FVWM, since it would unlock the
+    following packet.
+    """
+
+    def __init__(self,deadline=None,onexpire=None,size=1024):
+        self.deadline    = deadline
+        self.size        = size
+        self.samples     = dict()
+        self.autounlocks = 0
+        self._onexpire   = onexpire
+        ### (ptype, arrival time) of packets waiting for unlock
+        self._pending    = deque()
+        ### unlocks done by the watchdog, which are still to come
+        self._debt       = 0
+        self._lock       = threading.Lock()
+        self._changed    = threading.Condition(self._lock)
+        self._watchdog   = None
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def arrived(self,packs,syncmask):
+        """Note the packets in syncmask among packs"""
+        now = time.monotonic()
+        with self._lock:
+            for p in packs:
+                if p.ptype & syncmask:
+                    self._pending.append( (p.ptype, now) )
+            if not self._pending or self.deadline is None:
+                return
+            if self._watchdog is None:
+                self._watchdog = threading.Thread( target = self._watch,
+                                                   name   = "sync_watchdog",
+                                                   daemon = True )
+                self._watchdog.start()
+            self._changed.notify()
+
+    def unlocking(self):
+        """Note that m.unlock() is called. Return None if NOP UNLOCK
+        must not be sent, because the watchdog has already sent it,
+        otherwise the token to pass to unlocked() once it is sent.
+        """
+        with self._lock:
+            ### the late unlock of a packet unlocked by the watchdog,
+            ### which has already recorded its latency
+            if self._debt:
+                self._debt -= 1
+                return None
+            if self._pending:
+                token = self._pending.popleft()
+                self._changed.notify()
+                return token
+            return ()
+
+    def unlocked(self,token):
+        """Note that NOP UNLOCK for token from unlocking() is sent"""
+        if not token: return
+        now = time.monotonic()
+        ptype, t = token
+        with self._lock:
+            self._record(ptype,now-t)
+
+    def percentiles(self,ptype=None,q=(50,90,99)):
+        """Return { q : latency in seconds } for packets of type ptype
+        (or of all types if ptype is None) using the nearest rank.
+        """
+        with self._lock:
+            if ptype is None:
+                data = [ s for d in self.samples.values() for s in d ]
+            else:
+                data = list(self.samples.get(ptype,()))
+        if not data:
+            return dict()
+        data.sort()
+        n = len(data)
+        return { k : data[min(n-1,max(0,-(-k*n//100)-1))] for k in q }
+
+    def clear(self):
+        """Forget collected latencies"""
+        with self._lock:
+            self.samples.clear()
+            self.autounlocks = 0
+
+    def __repr__(self):
+        return "syncstats({})".format(", ".join(
+            "{}: {}".format(packetnames.get(ptype,ptype),
+                            " ".join( "p{}={:.2g}ms".format(k,v*1000)
+                                      for k, v in
+                                      self.percentiles(ptype).items() ))
+            for ptype in list(self.samples) ))
+
+    ### The following must be called with self._lock acquired
+    def _record(self,ptype,latency):
+        try:
+            self.samples[ptype].append(latency)
+        except KeyError:
+            self.samples[ptype] = deque((latency,),maxlen=self.size)
+
+    def _watch(self):
+        with self._lock:
+            while True:
+                if not self._pending or self.deadline is None:
+                    self._changed.wait()
+                    continue
+                ptype, t = self._pending[0]
+                waited = time.monotonic() - t
+                if waited < self.deadline:
+                    self._changed.wait(self.deadline - waited)
+                    continue
+                self._pending.popleft()
+                self._record(ptype,waited)
+                self._debt += 1
+                self.autounlocks += 1
+                self._lock.release()
+                try:
+                    self._onexpire(ptype,waited)
+                finally:
+                    self._lock.acquire()